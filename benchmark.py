@@ -0,0 +1,476 @@
+# Authors: Sergio Cárdenas & Adrián Cerezuela
+
+import igo
+import json
+import math
+import numpy as np
+import os
+import random
+import shutil
+import sys
+import time
+import tracemalloc
+import osmnx as ox
+
+
+GRAPH_FILENAME = 'barcelona.graph'
+PAIRS = 100
+SEED = 42
+# the fixture is a piece of the saved graph and a recording of the highways
+# and congestions data, so the suite runs offline and always on the same data
+FIXTURE_DIRECTORY = 'fixture'
+FIXTURE_RADIUS = 2000  # meters around the center of the graph
+REPEATS = 5  # runs of the stages that do not depend on the pairs
+SIZE = 800
+HIGHWAYS_URL = 'https://opendata-ajuntament.barcelona.cat/data/dataset/1090983a-1c40-4609-8620-14ad49aae3ab/resource/1d6c814c-70ef-4147-aa16-a49ddb952f72/download/transit_relacio_trams.csv'
+CONGESTIONS_URL = 'https://opendata-ajuntament.barcelona.cat/data/dataset/8319c2b1-4c21-4962-9acd-6db4c5ff1148/resource/2d456eb5-4ea6-4f68-9794-2f3f1a58a933/download'
+
+
+def random_pairs(igraph, pairs, seed):
+    """Returns a list of random (source, target) pairs of nodes.
+    ------------------------------------------------------------
+    Keyword arguments:
+    igraph -- Graph where we want to choose the nodes.
+    pairs -- Number of pairs we want.
+    seed -- Seed of the random generator, so the pairs can be repeated.
+    """
+
+    generator = random.Random(seed)
+    nodes = list(igraph.nodes)
+    return [(generator.choice(nodes), generator.choice(nodes))
+            for _ in range(pairs)]
+
+
+def time_engine(find_path, pairs):
+    """Returns the paths found by an engine and the seconds it took.
+    ----------------------------------------------------------------
+    Keyword arguments:
+    find_path -- Function that finds the path between a source and a target.
+    pairs -- List of (source, target) pairs of nodes.
+    """
+
+    start = time.perf_counter()
+    paths = [find_path(source, target) for source, target in pairs]
+    return paths, time.perf_counter() - start
+
+
+def settled(stats):
+    """Returns a new dictionary for the statistics of a search, which is also
+    appended to a list.
+    -------------------------------------------------------------------------
+    Keyword arguments:
+    stats -- List where we keep the statistics of every search.
+    """
+
+    stats.append({})
+    return stats[-1]
+
+
+def average_settled(stats):
+    """Returns the average number of settled nodes of a list of searches.
+    ---------------------------------------------------------------------
+    Keyword arguments:
+    stats -- List with the statistics of every search.
+    """
+
+    return sum(search['settled'] for search in stats)/max(len(stats), 1)
+
+
+def random_itimes(edge_arrays, seed):
+    """Returns the actual and planned itimes of the edges with random
+    congestion states, as no data is downloaded.
+    -----------------------------------------------------------------
+    Keyword arguments:
+    edge_arrays -- Edge arrays of the igraph.
+    seed -- Seed of the random generator, so the itimes can be repeated.
+    """
+
+    generator = np.random.default_rng(seed)
+    # from very fluid (1) to congestion (5), so that no street is cut
+    states = generator.integers(1, 6, size=(2, len(edge_arrays.lengths)))
+    values = igo.CONGESTION_VALUES[states]
+    actual, planned = edge_arrays.lengths/(edge_arrays.speeds*values)
+    return actual, planned
+
+
+def time_dependent(csr, edge_arrays, landmarks, pairs):
+    """Compares the static and the time-dependent searches over random
+    congestions, both their speed and the itime of the paths they find.
+    ------------------------------------------------------------------
+    Keyword arguments:
+    csr -- Compressed sparse row layout of the igraph.
+    edge_arrays -- Edge arrays of the igraph.
+    landmarks -- Landmarks of the igraph.
+    pairs -- List of (source, target) pairs of nodes.
+    """
+
+    actual, planned = random_itimes(edge_arrays, SEED)
+    csr = csr._replace(weights=actual)
+    # the lists of the layout are built once, as the workers of the bot do
+    lists = igo.csr_lists(csr, planned)
+    static_stats = []
+    static_paths, static_time = time_engine(
+        lambda source, target: igo.csr_shortest_path(
+            csr, source, target, stats=settled(static_stats), lists=lists),
+        pairs)
+    dependent_stats = []
+    dependent_paths, dependent_time = time_engine(
+        lambda source, target: igo.time_dependent_shortest_path(
+            csr, planned, source, target, stats=settled(dependent_stats),
+            lists=lists), pairs)
+    alt_stats = []
+    alt_paths, alt_time = time_engine(
+        lambda source, target: igo.time_dependent_shortest_path(
+            csr, planned, source, target,
+            potentials=igo.landmark_potentials(landmarks, csr.index[target]),
+            stats=settled(alt_stats), lists=lists), pairs)
+
+    # the static paths are driven with the planned congestions too, so both
+    # itimes are comparable
+    routed = [(igo.time_dependent_path_itime(csr, planned, path), search)
+              for path, search in zip(static_paths, dependent_stats)
+              if path is not None]
+    static_itime = sum(itime for itime, search in routed)
+    dependent_itime = sum(search['itime'] for itime, search in routed)
+    print("static: %.2f ms/query, %d settled nodes/query"
+          % (1000*static_time/len(pairs), average_settled(static_stats)))
+    print("time-dependent: %.2f ms/query (x%.2f), %d settled nodes/query"
+          % (1000*dependent_time/len(pairs), dependent_time/static_time,
+             average_settled(dependent_stats)))
+    print("time-dependent alt: %.2f ms/query (x%.2f), %d settled nodes/query"
+          % (1000*alt_time/len(pairs), alt_time/static_time,
+             average_settled(alt_stats)))
+    print("time-dependent paths: %.1f s/trip instead of %.1f s/trip (%d "
+          "different paths)"
+          % (igo.ITIME_SECONDS*dependent_itime/max(len(routed), 1),
+             igo.ITIME_SECONDS*static_itime/max(len(routed), 1),
+             sum(path1 != path2
+                 for path1, path2 in zip(static_paths, dependent_paths))))
+
+
+def main(pairs=PAIRS):
+    """Compares the NetworkX, the compressed sparse row, the A* and the ALT
+    engines over random origin-destination pairs of the saved graph, and
+    then the static and the time-dependent searches.
+    -----------------------------------------------------------------------
+    Keyword arguments:
+    pairs -- Number of origin-destination pairs we want to route.
+    """
+
+    # no data is downloaded, so every edge gets the default itime
+    graph = igo.load_graph(GRAPH_FILENAME)
+    igraph = igo.build_igraph(graph, [], igo.build_congestions([]), {})
+    csr = igo.build_csr(igraph)
+    edge_arrays = igo.build_edge_arrays(igraph, {})
+    start = time.perf_counter()
+    landmarks = igo.landmark_lists(igo.build_landmarks(csr, edge_arrays))
+    landmarks_time = time.perf_counter() - start
+    lists = igo.csr_lists(csr)
+    pairs = random_pairs(igraph, pairs, SEED)
+
+    networkx_paths, networkx_time = time_engine(
+        lambda source, target: ox.shortest_path(igraph, source, target,
+                                                'itime'), pairs)
+    csr_stats = []
+    csr_paths, csr_time = time_engine(
+        lambda source, target: igo.csr_shortest_path(
+            csr, source, target, stats=settled(csr_stats), lists=lists),
+        pairs)
+    astar_stats = []
+    astar_paths, astar_time = time_engine(
+        lambda source, target: igo.astar_shortest_path(
+            csr, source, target, settled(astar_stats), lists), pairs)
+    alt_stats = []
+    alt_paths, alt_time = time_engine(
+        lambda source, target: igo.alt_shortest_path(
+            csr, landmarks, source, target, settled(alt_stats), lists),
+        pairs)
+
+    matches = sum(path1 == path2
+                  for path1, path2 in zip(networkx_paths, csr_paths))
+    print("pairs: %d (%d identical paths)" % (len(pairs), matches))
+    print("networkx: %.2f ms/query" % (1000*networkx_time/len(pairs)))
+    print("csr: %.2f ms/query, %d settled nodes/query"
+          % (1000*csr_time/len(pairs), average_settled(csr_stats)))
+    matches = sum(path1 == path2
+                  for path1, path2 in zip(networkx_paths, astar_paths))
+    print("astar: %.2f ms/query, %d settled nodes/query (%d identical paths)"
+          % (1000*astar_time/len(pairs), average_settled(astar_stats),
+             matches))
+    matches = sum(path1 == path2
+                  for path1, path2 in zip(networkx_paths, alt_paths))
+    print("alt: %.2f ms/query, %d settled nodes/query (%d identical paths, "
+          "%.2f s of preprocessing)"
+          % (1000*alt_time/len(pairs), average_settled(alt_stats), matches,
+             landmarks_time))
+    time_dependent(csr, edge_arrays, landmarks, pairs)
+
+
+def make_fixture(FIXTURE_DIRECTORY=FIXTURE_DIRECTORY, radius=FIXTURE_RADIUS,
+                 HIGHWAYS_SOURCE=HIGHWAYS_URL,
+                 CONGESTIONS_SOURCE=CONGESTIONS_URL):
+    """Saves the fixture of the suite: the nodes of the saved graph around its
+    center and a recording of the highways and congestions data.
+    -------------------------------------------------------------------------
+    Keyword arguments:
+    FIXTURE_DIRECTORY -- Name of the directory where we save the fixture.
+    radius -- Meters around the center of the graph of the nodes we keep.
+    HIGHWAYS_SOURCE -- URL, or file (an archived snapshot, for example), of
+                       the highways data.
+    CONGESTIONS_SOURCE -- URL, or file, of the congestions data.
+    """
+
+    graph = igo.load_graph(GRAPH_FILENAME)
+    nodes, longitudes, latitudes = igo.node_coordinates(graph)
+    latitude = float(np.median(latitudes))
+    points = igo.project_coordinates(longitudes, latitudes, latitude)
+    center = igo.project_coordinates(np.median(longitudes), latitude,
+                                     latitude)
+    near = np.hypot(*(points - center).T) <= radius
+    os.makedirs(FIXTURE_DIRECTORY, exist_ok=True)
+    igo.save_graph(graph.subgraph(nodes[near].tolist()).copy(),
+                   os.path.join(FIXTURE_DIRECTORY, 'graph.pickle'))
+    for SOURCE, filename in [(HIGHWAYS_SOURCE, 'highways.csv'),
+                             (CONGESTIONS_SOURCE, 'congestions.csv')]:
+        with igo.open_url(SOURCE) as source, \
+                open(os.path.join(FIXTURE_DIRECTORY, filename), 'w',
+                     encoding='utf-8', newline='') as file:
+            shutil.copyfileobj(source, file)
+
+
+def time_stage(results, stage, mode, function, items, prepare=None):
+    """Runs a stage of the pipeline once for every item, and saves in a list
+    the percentiles of its latency, its peak memory and, if the function
+    returns statistics, the average number of settled nodes. The memory is
+    measured in a second run, so tracing it does not spoil the latencies.
+    ------------------------------------------------------------------------
+    Keyword arguments:
+    results -- List where we save the results of the stage.
+    stage -- Name of the stage.
+    mode -- Name of the engine or cache mode of the stage.
+    function -- Function that runs the stage for an item and returns a
+                dictionary of statistics or None.
+    items -- List of the items the stage is run for.
+    prepare -- Function called before each run, or None.
+    """
+
+    latencies = []
+    stats = []
+    if prepare is not None:
+        prepare()
+    for item in items:
+        start = time.perf_counter()
+        search = function(item)
+        latencies.append(time.perf_counter() - start)
+        if isinstance(search, dict) and 'settled' in search:
+            stats.append(search)
+    if prepare is not None:
+        prepare()
+    tracemalloc.start()
+    for item in items[:10]:
+        function(item)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    p50, p95, p99 = np.percentile(np.array(latencies)*1000, [50, 95, 99])
+    result = {'stage': stage, 'mode': mode, 'count': len(items),
+              'p50_ms': p50, 'p95_ms': p95, 'p99_ms': p99,
+              'mean_ms': 1000*sum(latencies)/len(latencies),
+              'peak_kib': peak/1024,
+              'settled': average_settled(stats) if stats else None}
+    results.append(result)
+    print("%-22s %-14s %6d runs  p50 %9.2f ms  p95 %9.2f ms  p99 %9.2f ms  "
+          "peak %9.1f KiB%s"
+          % (stage, mode, len(items), p50, p95, p99, result['peak_kib'],
+             "  %d settled" % result['settled'] if stats else ""))
+
+
+def suite(pairs=PAIRS, RESULTS_FILENAME=None,
+          FIXTURE_DIRECTORY=FIXTURE_DIRECTORY):
+    """Times every stage of the pipeline that answers '/go' (downloading the
+    data, building the igraph, finding the nodes, routing with every engine
+    and drawing the map, with and without the route cache) over the fixture
+    and random origin-destination pairs, and saves the results as JSON.
+    ------------------------------------------------------------------------
+    Keyword arguments:
+    pairs -- Number of origin-destination pairs we want to route.
+    RESULTS_FILENAME -- Name of the JSON file where we save the results, or
+                        None.
+    FIXTURE_DIRECTORY -- Name of the directory of the fixture.
+    """
+
+    HIGHWAYS_FILENAME = os.path.join(FIXTURE_DIRECTORY, 'highways.csv')
+    CONGESTIONS_FILENAME = os.path.join(FIXTURE_DIRECTORY, 'congestions.csv')
+    graph = igo.load_graph(os.path.join(FIXTURE_DIRECTORY, 'graph.pickle'))
+    results = []
+    runs = [None] * REPEATS
+
+    # data and igraph
+    time_stage(results, 'download_highways', 'file',
+               lambda _: igo.download_highways(HIGHWAYS_FILENAME), runs)
+    time_stage(results, 'download_congestions', 'file',
+               lambda _: igo.download_congestions(CONGESTIONS_FILENAME), runs)
+    highways = igo.download_highways(HIGHWAYS_FILENAME)
+    congestions = igo.download_congestions(CONGESTIONS_FILENAME)
+    time_stage(results, 'build_highway_edges', 'serial',
+               lambda _: igo.build_highway_edges(graph, highways), [None])
+    time_stage(results, 'build_highway_edges', 'processes',
+               lambda _: igo.build_highway_edges(graph, highways,
+                                                 processes=os.cpu_count()),
+               [None])
+    highway_edges = igo.build_highway_edges(graph, highways)
+    time_stage(results, 'build_igraph', 'networkx',
+               lambda _: igo.build_igraph(graph, highways, congestions,
+                                          highway_edges), runs)
+    igraph = igo.build_igraph(graph, highways, congestions, highway_edges)
+    edge_arrays = igo.build_edge_arrays(igraph, highway_edges)
+    time_stage(results, 'build_igraph', 'numpy',
+               lambda _: igo.build_igraph(graph, highways, congestions,
+                                          edge_arrays=edge_arrays), runs)
+    time_stage(results, 'compute_itimes', 'numpy',
+               lambda _: igo.compute_itimes(edge_arrays, congestions), runs)
+    csr = igo.build_csr(igraph)
+    time_stage(results, 'build_landmarks', 'alt',
+               lambda _: igo.build_landmarks(csr, edge_arrays), [None])
+    landmarks = igo.landmark_lists(igo.build_landmarks(csr, edge_arrays))
+    planned = igo.compute_itimes(edge_arrays, congestions, planned=True)
+    lists = igo.csr_lists(csr, planned)
+
+    # nodes of the locations, given as coordinates so nothing is geocoded
+    node_pairs = random_pairs(igraph, pairs, SEED)
+    locations = [(igraph.nodes[node]['y'], igraph.nodes[node]['x'])
+                 for pair in node_pairs for node in pair]
+    spatial_index = igo.build_spatial_index(igraph)
+    time_stage(results, 'get_node', 'spatial_index',
+               lambda location: igo.get_node(igraph, location,
+                                             spatial_index), locations)
+    time_stage(results, 'get_node', 'osmnx',
+               lambda location: igo.get_node(igraph, location), locations)
+
+    # routing, with every engine
+    engines = [('networkx', {}), ('csr', {'csr': csr, 'lists': lists}),
+               ('astar', {'csr': csr, 'astar': True, 'lists': lists}),
+               ('alt', {'csr': csr, 'landmarks': landmarks, 'lists': lists}),
+               ('time_dependent', {'csr': csr, 'landmarks': landmarks,
+                                   'planned': planned, 'lists': lists})]
+    for engine, arguments in engines:
+        def route(pair, arguments=arguments):
+            stats = {}
+            igo.get_shortest_path_with_ispeeds(igraph, *pair, stats=stats,
+                                               **arguments)
+            return stats
+        time_stage(results, 'shortest_path', engine, route, node_pairs)
+
+    # drawing, over the offline basemap
+    paths = [igo.alt_shortest_path(csr, landmarks, *pair, lists=lists)
+             for pair in node_pairs]
+    paths = [path for path in paths if path is not None and len(path) > 1]
+    basemap = igo.render_basemap(igraph, SIZE)
+    time_stage(results, 'plot_path', 'streets',
+               lambda path: igo.plot_path(igraph, path, SIZE, basemap), paths)
+
+    # the whole '/go', with a cold and a warm route cache
+    route_cache = igo.open_route_cache(len(node_pairs))
+
+    def go(pair):
+        route = igo.get_route(route_cache, 0, *pair)
+        if route is None:
+            path = igo.alt_shortest_path(csr, landmarks, *pair, lists=lists)
+            if path is None or len(path) < 2:
+                return None
+            route = igo.build_route(csr, path)
+        if route.image is None:
+            route = route._replace(image=igo.plot_path(igraph, route.path,
+                                                       SIZE, basemap))
+            igo.cache_route(route_cache, 0, *pair, route)
+        return None
+    time_stage(results, 'go', 'cold_cache', go, node_pairs,
+               route_cache.memory.clear)
+    time_stage(results, 'go', 'warm_cache', go, node_pairs,
+               lambda: [go(pair) for pair in node_pairs])
+    print("route cache: %d hits, %d misses" % (route_cache.stats['hits'],
+                                               route_cache.stats['misses']))
+
+    if RESULTS_FILENAME is not None:
+        with open(RESULTS_FILENAME, 'w') as file:
+            json.dump({'pairs': pairs, 'seed': SEED, 'results': results},
+                      file, indent=2)
+    return results
+
+
+def same_itime(itime1, itime2):
+    """Returns True if two itimes of paths are the same, up to the rounding
+    errors of adding them in a different order, or both are None (no path).
+    -----------------------------------------------------------------------
+    Keyword arguments:
+    itime1 -- Itime of the first path, or None.
+    itime2 -- Itime of the second path, or None.
+    """
+
+    if itime1 is None or itime2 is None:
+        return itime1 is None and itime2 is None
+    return math.isclose(itime1, itime2, rel_tol=1e-9)
+
+
+def check(pairs=PAIRS, FIXTURE_DIRECTORY=FIXTURE_DIRECTORY):
+    """Checks that the compressed sparse row, ALT, A* and time-dependent
+    engines find paths of the same itime over the fixture and random
+    origin-destination pairs, and returns the number of pairs where they do
+    not. The planned itimes are the actual ones, so the time-dependent
+    search has to find the static shortest paths too.
+    -----------------------------------------------------------------------
+    Keyword arguments:
+    pairs -- Number of origin-destination pairs we want to route.
+    FIXTURE_DIRECTORY -- Name of the directory of the fixture.
+    """
+
+    graph = igo.load_graph(os.path.join(FIXTURE_DIRECTORY, 'graph.pickle'))
+    highways = igo.download_highways(
+        os.path.join(FIXTURE_DIRECTORY, 'highways.csv'))
+    congestions = igo.download_congestions(
+        os.path.join(FIXTURE_DIRECTORY, 'congestions.csv'))
+    highway_edges = igo.build_highway_edges(graph, highways)
+    igraph = igo.build_igraph(graph, highways, congestions, highway_edges)
+    edge_arrays = igo.build_edge_arrays(igraph, highway_edges)
+    csr = igo.build_csr(igraph)
+    landmarks = igo.landmark_lists(igo.build_landmarks(csr, edge_arrays))
+    planned = csr.weights
+    lists = igo.csr_lists(csr, planned)
+    engines = [
+        ('csr', lambda source, target: igo.csr_shortest_path(
+            csr, source, target, lists=lists)),
+        ('alt', lambda source, target: igo.alt_shortest_path(
+            csr, landmarks, source, target, lists=lists)),
+        ('astar', lambda source, target: igo.astar_shortest_path(
+            csr, source, target, lists=lists)),
+        ('time_dependent', lambda source, target:
+            igo.time_dependent_shortest_path(csr, planned, source, target,
+                                             lists=lists))]
+
+    mismatches = 0
+    for source, target in random_pairs(igraph, pairs, SEED):
+        itimes = {}
+        for engine, find_path in engines:
+            path = find_path(source, target)
+            itimes[engine] = (None if path is None
+                              else igo.build_route(csr, path).itime)
+        if not all(same_itime(itime, itimes['csr'])
+                   for itime in itimes.values()):
+            mismatches += 1
+            print("%s -> %s: %s" % (source, target, itimes))
+    print("check: %d pairs, %d with different itimes" % (pairs, mismatches))
+    return mismatches
+
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ['fixture']:
+        make_fixture(FIXTURE_DIRECTORY, FIXTURE_RADIUS, *sys.argv[2:])
+    elif sys.argv[1:2] == ['suite']:
+        arguments = sys.argv[2:]
+        suite(int(arguments[0]) if arguments else PAIRS, *arguments[1:])
+    elif sys.argv[1:2] == ['check']:
+        arguments = sys.argv[2:]
+        if check(int(arguments[0]) if arguments else PAIRS, *arguments[1:]):
+            sys.exit(1)
+    else:
+        main(*[int(argument) for argument in sys.argv[1:]])
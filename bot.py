@@ -1,40 +1,163 @@
 # Authors: Sergio Cárdenas & Adrián Cerezuela
 
 import igo
-import random
+import worker
+import metrics
 import os
+import time
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from telegram.ext import Updater, CommandHandler, MessageHandler, Filters
-from staticmap import StaticMap, CircleMarker
 from datetime import datetime, timedelta
 
 
 PLACE = 'Barcelona, Catalonia'
 GRAPH_FILENAME = 'barcelona.graph'
+HIGHWAY_EDGES_FILENAME = 'barcelona.highways'
+ROUTING_DIRECTORY = 'barcelona.routing'
+SPATIAL_INDEX_FILENAME = 'barcelona.index'
+GEOCODE_FILENAME = 'geocodes.db'
+GEOCODE_SEED_FILENAME = 'places.csv'
 SIZE = 800
+# background of the maps: 'tiles' (city map rendered once), 'streets'
+# (offline drawing of the streets) or None (map tiles of every map)
+BASEMAP = 'tiles'
+TILES_DIRECTORY = 'tiles'
+TILE_DOWNLOADS = 4  # map tiles downloaded at the same time by all processes
+IMAGE_FORMAT = 'PNG'  # PNG, JPEG or WEBP
+IMAGE_OPTIONS = {'compress_level': 1}  # encoding options of the format
+UPDATE_INTERVAL = 300  # seconds between two congestions downloads
+# number of processes that compute and draw the paths, or 0 to do it in
+# threads of the bot process
+WORKERS = os.cpu_count()
+WEIGHTS_DIRECTORY = 'barcelona.weights'
+# if it is True, the edges reached 15 minutes into the trip have the itime of
+# the planned congestions instead of the actual ones
+PLANNED = True
+ROUTE_CACHE_SIZE = 1024  # routes kept by every worker
+ROUTE_CACHE_IMAGES = True  # if the maps of the routes are also kept
+SESSIONS_FILENAME = 'sessions.pickle'
+SESSION_TTL = 24*3600  # seconds the position of a user is kept
+SESSIONS_INTERVAL = 60  # seconds between two savings of the sessions
+# every distinct download of the highways and congestions data is archived
+# here, so it can be replayed
+ARCHIVE_DIRECTORY = 'snapshots'
+# port of the local endpoint of the metrics (http://127.0.0.1:9464/metrics),
+# or None to not serve them
+METRICS_PORT = 9464
+METRICS_INTERVAL = 0  # seconds between two logged metrics lines, or 0
 HIGHWAYS_URL = 'https://opendata-ajuntament.barcelona.cat/data/dataset/1090983a-1c40-4609-8620-14ad49aae3ab/resource/1d6c814c-70ef-4147-aa16-a49ddb952f72/download/transit_relacio_trams.csv'
 CONGESTIONS_URL = 'https://opendata-ajuntament.barcelona.cat/data/dataset/8319c2b1-4c21-4962-9acd-6db4c5ff1148/resource/2d456eb5-4ea6-4f68-9794-2f3f1a58a933/download'
 
 
-def startup():
-    """Starts-up our bot by downloading all the necessary resources.
+def build_routing_data():
+    """Builds the routing data from the graph of the place, downloading it
+    and matching the highways if it is necessary, and saves it.
     """
 
-    # we will use the following global variables
-    global graph, igraph, highways, congestions, last_download
     # load/download graph (using cache)
     if not igo.exists_graph(GRAPH_FILENAME):
         graph = igo.download_graph(PLACE)
         igo.save_graph(graph, GRAPH_FILENAME)
-    else:
+    # build the highway-to-edges mapping (using cache), so that the graph
+    # can be converted again without matching the highways, and again if the
+    # graph has been downloaded since it was saved
+    signature = igo.graph_signature(GRAPH_FILENAME)
+    highway_edges = None
+    if igo.exists_graph(HIGHWAY_EDGES_FILENAME):
+        highway_edges = igo.load_highway_edges(HIGHWAY_EDGES_FILENAME,
+                                               signature)
+    if highway_edges is None:
         graph = igo.load_graph(GRAPH_FILENAME)
-    highways = igo.download_highways(HIGHWAYS_URL)
-    congestions = igo.download_congestions(CONGESTIONS_URL)
+        highways = igo.download_highways(HIGHWAYS_URL, fetcher=fetcher)
+        # the highways are matched by a process for every core
+        highway_edges = igo.build_highway_edges(graph, highways,
+                                                processes=os.cpu_count())
+        igo.save_highway_edges(highway_edges, HIGHWAY_EDGES_FILENAME,
+                               signature)
+    igo.convert_graph(GRAPH_FILENAME, HIGHWAY_EDGES_FILENAME,
+                      ROUTING_DIRECTORY)
+
+
+def startup():
+    """Starts-up our bot by downloading all the necessary resources.
+    """
+
+    # we will use the following global variables
+    global routing_data, edge_arrays, congestions, last_download
+    global weights_version, weights_filenames, workers, fetcher
+    # the data is downloaded over persistent connections, and only when it
+    # has changed
+    fetcher = igo.open_fetcher(ARCHIVE_DIRECTORY)
+    # load/build the routing data (using cache), which is memory-mapped so it
+    # is loaded in a few milliseconds
+    if not igo.exists_graph(os.path.join(ROUTING_DIRECTORY, 'nodes.npy')):
+        build_routing_data()
+    routing_data = igo.load_routing_data(ROUTING_DIRECTORY)
+    edge_arrays = routing_data.edge_arrays
+    # the geocoded locations are cached, and the common places can be given
+    # beforehand so they are never geocoded
+    geocode_cache = igo.open_geocode_cache(GEOCODE_FILENAME)
+    if igo.exists_graph(GEOCODE_SEED_FILENAME):
+        seed_stats = {}
+        igo.seed_geocode_cache(geocode_cache, GEOCODE_SEED_FILENAME,
+                               seed_stats)
+        if seed_stats.get('skipped'):
+            print('%d malformed lines of %s skipped' % (
+                seed_stats['skipped'], GEOCODE_SEED_FILENAME))
+    # build the spatial index of the graph (using cache), again if the
+    # routing data has been rebuilt since it was saved
+    igo.load_spatial_index(SPATIAL_INDEX_FILENAME, routing_data)
+    congestions = igo.download_congestions(CONGESTIONS_URL, fetcher=fetcher)
     last_download = datetime.now()
-    igraph = igo.build_igraph(graph, highways, congestions)
-    # we declare the users_information variable as a list, where we will store
-    # the current position and ID of the different users
-    global users_information
-    users_information = []
+    # the shortest paths are found over the compressed layout of the graph,
+    # whose weights are the itimes computed at once with NumPy and published
+    # as a file the workers memory-map
+    weights_version = 0
+    weights_filenames = publish_weights(congestions, weights_version)
+    # the map tiles are cached, and the basemap is drawn once and reused by
+    # every map. Every worker keeps its own tiles in memory, but they share
+    # the directory and a semaphore that bounds the downloads of all of them
+    tile_downloads = multiprocessing.get_context('fork').BoundedSemaphore(
+        TILE_DOWNLOADS)
+    tile_cache = igo.open_tile_cache(TILES_DIRECTORY,
+                                     downloads=tile_downloads)
+    basemap = None
+    if (BASEMAP == 'tiles'):
+        basemap = igo.render_tile_basemap(routing_data, SIZE, tile_cache)
+    elif (BASEMAP == 'streets'):
+        basemap = igo.render_basemap(routing_data, SIZE)
+    # the paths are computed and drawn by a pool of workers, so the handlers
+    # of the bot never wait for them
+    worker_arguments = (ROUTING_DIRECTORY, SPATIAL_INDEX_FILENAME,
+                        GEOCODE_FILENAME, TILES_DIRECTORY, basemap,
+                        {'SIZE': SIZE, 'format': IMAGE_FORMAT,
+                         'options': IMAGE_OPTIONS,
+                         'images': ROUTE_CACHE_IMAGES}, ROUTE_CACHE_SIZE,
+                        tile_downloads)
+    if (WORKERS > 0):
+        # the workers are forked now, before the bot starts any thread
+        workers = ProcessPoolExecutor(WORKERS,
+                                      multiprocessing.get_context('fork'),
+                                      worker.init, worker_arguments)
+        for future in [workers.submit(int) for i in range(WORKERS)]:
+            future.result()
+    else:
+        worker.init(*worker_arguments)
+        workers = ThreadPoolExecutor()
+    # we keep the current position of the different users, and its nearest
+    # node, by their chat ID, and they are saved so a restart keeps them (the
+    # nodes only if they are still in the graph)
+    global sessions
+    sessions = igo.open_session_store(SESSIONS_FILENAME, SESSION_TTL,
+                                      routing_data.csr.index)
+    # the latency of every stage, the hits of the caches and the errors are
+    # measured all the time, and the age of the congestions when asked
+    metrics.gauge('snapshot_age_seconds',
+                  lambda: (datetime.now() - last_download).total_seconds())
+    metrics.gauge('weights_version', lambda: weights_version)
+    if METRICS_PORT is not None:
+        metrics.serve(METRICS_PORT)
 
 startup()
 
@@ -70,26 +193,93 @@ def author(update, context):
 
 
 def source_pos(chat_id):
-    """Given the current chat ID, searches in the users_information list the
-    user with the same ID and returns its position.
+    """Given the current chat ID, returns the nearest node of the position of
+    the user, or its position if the node has not been found yet.
+    """
+
+    session = igo.get_session(sessions, chat_id)
+    if session is None:
+        return None
+    if session.node is not None:
+        return session.node
+    return session.position
+
+
+def publish_weights(congestions, version):
+    """Publishes a version of the itimes of the actual and, if they are used,
+    the planned congestions, and returns the names of their files.
     """
 
-    for user_position, user_id in users_information:
-        if (user_id == chat_id):
-            return user_position
+    itimes = igo.compute_itimes(edge_arrays, congestions)
+    weights_filename = igo.save_weights(itimes, WEIGHTS_DIRECTORY, version)
+    planned_filename = None
+    if PLANNED:
+        planned = igo.compute_itimes(edge_arrays, congestions, planned=True)
+        planned_filename = igo.save_weights(planned, WEIGHTS_DIRECTORY,
+                                            version, 'planned')
+    return weights_filename, planned_filename
 
 
-def update_igraph(update, context):
-    """Update the igraph if it was last updated more than 5 minutes ago.
+def update_igraph(context):
+    """Downloads the congestions data again and updates the itimes. It is
+    executed periodically by the job queue, so users never wait for it.
     """
 
-    global igraph, last_download
-    current_datetime = datetime.now()
-    elapsed_time = current_datetime - last_download
-    seconds_passed = elapsed_time.total_seconds()
-    if (seconds_passed > 300):
-        last_download = current_datetime
-        igraph = igo.build_igraph(graph, highways, congestions)
+    global congestions, last_download, weights_version, weights_filenames
+    try:
+        with metrics.timed('refresh'):
+            new_congestions = igo.download_congestions(CONGESTIONS_URL,
+                                                       fetcher=fetcher)
+            # nothing is parsed nor computed again if the data has not
+            # changed
+            if new_congestions is None:
+                return
+            # the new itimes are published as a new version of the weights,
+            # and the requests sent from now on are computed with it
+            weights_filenames = publish_weights(new_congestions,
+                                                weights_version + 1)
+            weights_version += 1
+            congestions = new_congestions
+            last_download = datetime.now()
+            # the version before the previous one is not used by any request
+            for name in ['weights', 'planned']:
+                old_filename = os.path.join(WEIGHTS_DIRECTORY, '%s-%d.npy'
+                                            % (name, weights_version - 2))
+                if os.path.exists(old_filename):
+                    os.remove(old_filename)
+    except Exception as e:
+        print(e)
+
+
+def send_photo(context, chat_id, future, command, start):
+    """Sends the user the map computed by a worker, or a bomb if it failed,
+    and measures the whole request.
+    """
+
+    try:
+        # the metrics of the worker come with the image
+        image, samples = future.result()
+        metrics.merge(samples)
+        # the image is sent straight from memory
+        with metrics.timed('send'):
+            context.bot.send_photo(chat_id=chat_id, photo=image)
+    except Exception as e:
+        print(e)
+        metrics.count('errors', (('stage', command),))
+        context.bot.send_message(chat_id=chat_id, text='💣')
+    metrics.observe(command, time.perf_counter() - start)
+
+
+def dispatch(context, chat_id, function, *args):
+    """Sends a request to the workers and returns at once. The map is sent
+    when it is ready, from a thread of the bot.
+    """
+
+    start = time.perf_counter()
+    future = workers.submit(function, *args)
+    future.add_done_callback(
+        lambda future: context.dispatcher.run_async(
+            send_photo, context, chat_id, future, function.__name__, start))
 
 
 def go(update, context):
@@ -98,44 +288,66 @@ def go(update, context):
     will be executed when the bot receives the message '/go'.
     """
 
-    # checks if it is necessary to update the igraph
-    update_igraph(update, context)
     try:
         # if there is no arguments on the 0 position it means that target
         # location has not been read, so it will raise an exception
         context.args[0]
-        # we save the target and source locations as string-type variables
+        # we save the target location as a string-type variable, and the
+        # source is the node of the user's position if it is already found
         target = ' '.join(context.args)
         source = source_pos(update.effective_chat.id)
-        # we find the shortest path to go from the source to the target and
-        # plot it using the get_shortest_path_with_ispeeds and plot_path
-        # functions from the igo module
-        ipath = igo.get_shortest_path_with_ispeeds(igraph, source, target)
-        igo.plot_path(igraph, ipath, SIZE)
-        context.bot.send_photo(chat_id=update.effective_chat.id,
-                               photo=open('shortestpath.png', 'rb'))
+        # a worker finds the shortest path to go from the source to the
+        # target and plots it, with the weights of the congestions we have
+        # now even if they are updated meanwhile
+        dispatch(context, update.effective_chat.id, worker.go, source, target,
+                 *weights_filenames)
     except Exception as e:
         print(e)
+        metrics.count('errors', (('stage', 'go'),))
         context.bot.send_message(chat_id=update.effective_chat.id, text='💣')
 
 
+def save_node(chat_id, current_location, future):
+    """Saves the nearest node of the user's position found by a worker.
+    """
+
+    try:
+        node, samples = future.result()
+        metrics.merge(samples)
+        igo.set_session_node(sessions, chat_id, current_location, node)
+    except Exception as e:
+        print(e)
+        metrics.count('errors', (('stage', 'locate'),))
+
+
 def save_current_location(current_location, chat_id):
-    """Saves the current user's position and its ID in a list.
+    """Saves the current user's position by its ID, and asks a worker for
+    its nearest node, so it is only geocoded once.
     """
 
-    global users_information
-    user_already_exists = False  # checks if the user already exists
-    list_position = 0
-    for user_position, user_id in users_information:
-        # if the ID of the current user matches any ID in the list, we will
-        # replace its saved location in the list with the current one
-        if (user_id == chat_id):
-            users_information[list_position][0] = current_location
-            user_already_exists = True
-        ++list_position
-    if (not user_already_exists):
-        # if the user does not exist, we will add its information to the list
-        users_information.append([current_location, chat_id])
+    igo.save_session(sessions, chat_id, current_location)
+    future = workers.submit(worker.locate, current_location)
+    future.add_done_callback(
+        lambda future: save_node(chat_id, current_location, future))
+
+
+def save_sessions(context):
+    """Saves the sessions of the users. It is executed periodically by the
+    job queue.
+    """
+
+    try:
+        igo.save_session_store(sessions)
+    except Exception as e:
+        print(e)
+
+
+def log_metrics(context):
+    """Prints a structured line with the metrics of the bot. It is executed
+    periodically by the job queue.
+    """
+
+    print(metrics.summary())
 
 
 def where(update, context):
@@ -147,19 +359,14 @@ def where(update, context):
         lat = update.message.location.latitude
         lon = update.message.location.longitude
         current_location = lat, lon
-        # we save the location of the user in the users_information list
+        # we save the location of the user in its session
         save_current_location(current_location, update.effective_chat.id)
-        # we will show the user its location in a map of given size
-        file = "%d.png" % random.randint(1000000, 9999999)
-        map = StaticMap(SIZE, SIZE)
-        map.add_marker(CircleMarker((lon, lat), 'blue', 10))
-        image = map.render()
-        image.save(file)
-        context.bot.send_photo(chat_id=update.effective_chat.id,
-                               photo=open(file, 'rb'))
-        os.remove(file)
+        # we will show the user its location in a map of given size, which
+        # is drawn by a worker
+        dispatch(context, update.effective_chat.id, worker.where, (lon, lat))
     except Exception as e:
         print(e)
+        metrics.count('errors', (('stage', 'where'),))
         context.bot.send_message(chat_id=update.effective_chat.id, text='💣')
 
 
@@ -174,10 +381,11 @@ def pos(update, context):
         context.args[0]
         # we save the current user location as string-type variables
         current_location = ' '.join(context.args)
-        # we save the position of the user in the users_information list
+        # we save the position of the user in its session
         save_current_location(current_location, update.effective_chat.id)
     except Exception as e:
         print(e)
+        metrics.count('errors', (('stage', 'pos'),))
         context.bot.send_message(chat_id=update.effective_chat.id, text='💣')
 
 
@@ -197,5 +405,18 @@ dispatcher.add_handler(CommandHandler('go', go))
 dispatcher.add_handler(CommandHandler('pos', pos))
 dispatcher.add_handler(MessageHandler(Filters.location, where))
 
+# downloads the congestions data periodically in the background
+updater.job_queue.run_repeating(update_igraph, interval=UPDATE_INTERVAL,
+                                first=UPDATE_INTERVAL)
+
+# saves the sessions of the users periodically
+updater.job_queue.run_repeating(save_sessions, interval=SESSIONS_INTERVAL,
+                                first=SESSIONS_INTERVAL)
+
+# logs the metrics of the bot periodically, if it is asked to
+if (METRICS_INTERVAL > 0):
+    updater.job_queue.run_repeating(log_metrics, interval=METRICS_INTERVAL,
+                                    first=METRICS_INTERVAL)
+
 # turns on the bot
 updater.start_polling()
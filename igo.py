@@ -1,17 +1,91 @@
 # Authors: Sergio Cárdenas & Adrián Cerezuela
 
 import collections
+import heapq
+import math
+import numpy as np
 import networkx as nx
 import osmnx as ox
 import pickle
+import sqlite3
+import threading
+import concurrent.futures
+import multiprocessing
+import time
+import urllib.error
+import urllib.parse
 import urllib.request
 import csv
+import gzip
+import hashlib
+import http.client
+import io
+import os
+import requests
+from datetime import datetime
+from scipy.spatial import cKDTree
 from staticmap import StaticMap, Line, CircleMarker
+from PIL import Image, ImageDraw
 
 
 Highway = collections.namedtuple('Highway', ['way_id', 'description',
                                  'coordinates'])
-Congestion = collections.namedtuple('Congestion', ['way_id', 'date', 'state'])
+# every array is indexed by the way_id of the highway
+Congestions = collections.namedtuple('Congestions', ['actual', 'planned',
+                                     'date'])
+# every array is aligned with the order of the edges of the igraph
+EdgeArrays = collections.namedtuple('EdgeArrays', ['edges', 'lengths',
+                                    'speeds', 'way_ids'])
+# compressed sparse row layout of a directed graph, where the edges of the
+# node i are stored between offsets[i] and offsets[i+1]
+Csr = collections.namedtuple('Csr', ['nodes', 'index', 'x', 'y', 'offsets',
+                             'targets', 'weights', 'lengths'])
+# the same layout, and the planned itimes, as plain lists, which are much
+# faster than arrays when read element by element, and the maximum effective
+# speed of its edges. They are built once for every version of the weights,
+# and reused by all the searches
+CsrLists = collections.namedtuple('CsrLists', ['offsets', 'targets',
+                                  'weights', 'planned', 'speed'])
+# coordinates of the geometry of every edge, stored between offsets[i] and
+# offsets[i+1] for the edge i
+Geometries = collections.namedtuple('Geometries', ['offsets', 'x', 'y'])
+# routing-ready graph that can be saved as arrays and memory-mapped
+RoutingData = collections.namedtuple('RoutingData', ['csr', 'edge_arrays',
+                                     'geometries', 'landmarks'])
+# KD-tree over the projected coordinates of the nodes of a graph
+SpatialIndex = collections.namedtuple('SpatialIndex', ['tree', 'nodes',
+                                      'latitude'])
+# cache of geocoded locations with an in-memory LRU and an on-disk tier
+GeocodeCache = collections.namedtuple('GeocodeCache', ['memory', 'connection',
+                                      'lock', 'ttl', 'size', 'disk_size',
+                                      'stats'])
+# image of a map and the web mercator tile coordinates of its center
+Basemap = collections.namedtuple('Basemap', ['image', 'zoom', 'x_center',
+                                 'y_center'])
+# cache of map tiles with an in-memory LRU and an on-disk tier
+TileCache = collections.namedtuple('TileCache', ['directory', 'memory',
+                                   'lock', 'size', 'downloads', 'stats'])
+# persistent connections by (scheme, host), and the ETag, Last-Modified and
+# digest of the last payload of every URL
+Fetcher = collections.namedtuple('Fetcher', ['connections', 'validators',
+                                 'lock', 'directory', 'timeout', 'stats'])
+# LRU of the routes found for every (version of the weights, source, target)
+RouteCache = collections.namedtuple('RouteCache', ['memory', 'lock', 'size',
+                                    'stats'])
+# path, positions of its edges in the compressed layout, its itime and length
+# and, once it is drawn, the encoded image of its map
+Route = collections.namedtuple('Route', ['path', 'positions', 'itime',
+                               'length', 'image'])
+# last position of a user, its nearest node once it is found, and the
+# timestamp when it expires
+Session = collections.namedtuple('Session', ['position', 'node', 'expires'])
+# sessions of the users by chat ID, from the one that expires first
+SessionStore = collections.namedtuple('SessionStore', ['memory', 'lock',
+                                      'ttl', 'filename'])
+# lower bounds of the itime from every landmark to every node (forward) and
+# from every node to every landmark (backward)
+Landmarks = collections.namedtuple('Landmarks', ['nodes', 'forward',
+                                   'backward'])
 
 
 def exists_graph(GRAPH_FILENAME):
@@ -85,75 +159,478 @@ def plot_graph(graph):
 
 
 def fix_coordinates(coordinates):
-    """Returns a list of fixed format coordinates.
-    ----------------------------------------------
+    """Returns an array with a (longitude, latitude) row for every point of a
+    highway. It raises a ValueError if the coordinates are malformed.
+    -------------------------------------------------------------------------
     Keyword arguments:
-    coordinates -- List of coordinates representing points on a highway.
+    coordinates -- String of comma separated coordinates representing points
+                   on a highway.
     """
 
-    # separates each coordinate string
-    coordinates = coordinates.split(',')
-    # converts each coordinate string into a float
-    coordinates = [float(coordinate) for coordinate in coordinates]
-    # groups every pair of coordinates (longitude and latitude)
-    coordinates_pairs = list(zip(*[iter(coordinates)] * 2))
-    return coordinates_pairs
+    # converts every coordinate string into a float and groups every pair of
+    # coordinates (longitude and latitude) in a row
+    return np.array(coordinates.split(','), dtype=float).reshape(-1, 2)
 
 
-def download_highways(HIGHWAYS_URL):
-    """Downloads highways data from a URL.
-    --------------------------------------
+def open_fetcher(ARCHIVE_DIRECTORY=None, timeout=30):
+    """Returns a fetcher that downloads URLs over persistent connections and
+    only when they have changed since the last time.
+    ------------------------------------------------------------------------
+    Keyword arguments:
+    ARCHIVE_DIRECTORY -- Name of the directory where every distinct payload
+                         is archived compressed. If it is None, the payloads
+                         are not archived.
+    timeout -- Seconds to wait for the server.
+    """
+
+    if ARCHIVE_DIRECTORY is not None:
+        os.makedirs(ARCHIVE_DIRECTORY, exist_ok=True)
+    return Fetcher({}, {}, threading.Lock(), ARCHIVE_DIRECTORY, timeout,
+                   collections.Counter())
+
+
+def fetch_response(fetcher, URL, headers):
+    """Sends a GET request over a persistent connection to the host of a URL
+    and returns the response, whose content is left to be read, and the
+    connection. The connection is taken out of the fetcher until it is given
+    back with release_connection, once the response has been read.
+    ------------------------------------------------------------------------
+    Keyword arguments:
+    fetcher -- Fetcher that keeps the connections.
+    URL -- The URL we want to request.
+    headers -- Dictionary with the headers of the request.
+    """
+
+    parts = urllib.parse.urlsplit(URL)
+    key = (parts.scheme, parts.netloc)
+    path = (parts.path or '/') + ('?' + parts.query if parts.query else '')
+    for attempt in range(2):
+        with fetcher.lock:
+            connection = fetcher.connections.pop(key, None)
+        if connection is None:
+            if (parts.scheme == 'https'):
+                connection = http.client.HTTPSConnection(
+                    parts.netloc, timeout=fetcher.timeout)
+            else:
+                connection = http.client.HTTPConnection(
+                    parts.netloc, timeout=fetcher.timeout)
+        try:
+            connection.request('GET', path, headers=headers)
+            return connection.getresponse(), connection
+        except (http.client.HTTPException, OSError):
+            # the server may have closed the connection since the last
+            # request, so it is opened again once
+            connection.close()
+            if (attempt == 1):
+                raise
+
+
+def release_connection(fetcher, URL, connection):
+    """Gives back to a fetcher the connection of a response that has been
+    read, so it is reused by the next request to the same host.
+    ---------------------------------------------------------------------
     Keyword arguments:
-    HIGHWAYS_URL -- The URL where we want to download the highways data from.
+    fetcher -- Fetcher that keeps the connections.
+    URL -- The URL that was requested.
+    connection -- Connection of the response.
     """
 
-    with urllib.request.urlopen(HIGHWAYS_URL) as response:
-        lines = [l.decode('utf-8') for l in response.readlines()]
-        reader = csv.reader(lines, delimiter=',', quotechar='"')
-        next(reader)  # ignore first line with description
+    parts = urllib.parse.urlsplit(URL)
+    with fetcher.lock:
+        # another request may have opened a connection meanwhile
+        if fetcher.connections.setdefault((parts.scheme, parts.netloc),
+                                          connection) is connection:
+            return
+    connection.close()
+
+
+def archive_snapshot(fetcher, URL, temporary, digest):
+    """Moves a payload of a URL, compressed aside while it was downloaded,
+    into the archive directory, unless it is the last one archived.
+    ----------------------------------------------------------------------
+    Keyword arguments:
+    fetcher -- Fetcher with the archive directory.
+    URL -- The URL of the payload.
+    temporary -- Name of the compressed file of the payload.
+    digest -- SHA-256 digest of the payload.
+    """
+
+    prefix = hashlib.sha256(URL.encode('utf-8')).hexdigest()[:8]
+    snapshots = archived_snapshots(fetcher.directory, URL)
+    if snapshots and snapshots[-1].endswith('-%s.gz' % digest[:16]):
+        os.remove(temporary)
+        return
+    date = datetime.now().strftime('%Y%m%d%H%M%S%f')
+    filename = '%s-%s-%s.gz' % (prefix, date, digest[:16])
+    os.replace(temporary, os.path.join(fetcher.directory, filename))
+    fetcher.stats['archived'] += 1
+
+
+def archived_snapshots(ARCHIVE_DIRECTORY, URL):
+    """Returns the files of the archived payloads of a URL, from the oldest
+    to the newest. They can be read again with download_highways and
+    download_congestions.
+    -----------------------------------------------------------------------
+    Keyword arguments:
+    ARCHIVE_DIRECTORY -- Name of the directory of the archive.
+    URL -- The URL of the payloads.
+    """
+
+    prefix = hashlib.sha256(URL.encode('utf-8')).hexdigest()[:8] + '-'
+    return [os.path.join(ARCHIVE_DIRECTORY, filename)
+            for filename in sorted(os.listdir(ARCHIVE_DIRECTORY))
+            if filename.startswith(prefix) and filename.endswith('.gz')]
+
+
+class FetchedPayload(io.RawIOBase):
+    """Binary stream of the payload of a response, which computes its digest
+    and archives it compressed while it is read, so it is parsed as it is
+    downloaded and never kept whole in memory. Once it has been read to its
+    end, the validators of the URL are saved and unchanged tells if it is
+    the same payload as the last time. If it is closed before, nothing is
+    saved, so the URL is downloaded again the next time.
+    """
+
+    def __init__(self, fetcher, URL, location, response, connection,
+                 digest):
+        super().__init__()
+        self.fetcher = fetcher
+        self.URL = URL
+        self.location = location
+        self.response = response
+        self.connection = connection
+        self.digest = digest
+        self.unchanged = False
+        self.sha256 = hashlib.sha256()
+        self.source = response
+        if (response.getheader('Content-Encoding') == 'gzip'):
+            self.source = gzip.GzipFile(fileobj=response, mode='rb')
+        self.temporary = None
+        self.archive = None
+        if fetcher.directory is not None:
+            prefix = hashlib.sha256(URL.encode('utf-8')).hexdigest()[:8]
+            self.temporary = os.path.join(
+                fetcher.directory, '%s-%d-%d.tmp' % (
+                    prefix, os.getpid(), threading.get_ident()))
+            self.archive = gzip.open(self.temporary, 'wb')
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        data = self.source.read(len(buffer))
+        if not data:
+            self.finish()
+            return 0
+        self.sha256.update(data)
+        if self.archive is not None:
+            self.archive.write(data)
+        buffer[:len(data)] = data
+        return len(data)
+
+    def finish(self):
+        if self.response is None:
+            return
+        fetcher = self.fetcher
+        response = self.response
+        self.response = None
+        release_connection(fetcher, self.location, self.connection)
+        digest = self.sha256.hexdigest()
+        with fetcher.lock:
+            fetcher.validators[self.URL] = (response.getheader('ETag'),
+                                            response.getheader(
+                                                'Last-Modified'),
+                                            digest)
+            # some servers send no validators, so the payload is compared
+            # too
+            if (digest == self.digest):
+                fetcher.stats['unchanged'] += 1
+                self.unchanged = True
+            else:
+                fetcher.stats['downloads'] += 1
+        if self.archive is not None:
+            self.archive.close()
+            self.archive = None
+            if self.unchanged:
+                os.remove(self.temporary)
+            else:
+                archive_snapshot(fetcher, self.URL, self.temporary, digest)
+
+    def close(self):
+        if self.response is not None:
+            # the rest of the payload is not read, so the connection is not
+            # reused
+            self.response.close()
+            self.connection.close()
+            self.response = None
+            if self.archive is not None:
+                self.archive.close()
+                self.archive = None
+                os.remove(self.temporary)
+        super().close()
+
+
+def fetch(fetcher, URL):
+    """Returns a binary stream of the payload of a URL, which is read while
+    it is downloaded, or None if the server tells it has not changed since
+    the last time it was fetched.
+    ------------------------------------------------------------------------
+    Keyword arguments:
+    fetcher -- Fetcher used to download the URL.
+    URL -- The URL we want to download.
+    """
+
+    with fetcher.lock:
+        etag, modified, digest = fetcher.validators.get(URL,
+                                                        (None, None, None))
+    headers = {'Accept-Encoding': 'gzip'}
+    if etag is not None:
+        headers['If-None-Match'] = etag
+    if modified is not None:
+        headers['If-Modified-Since'] = modified
+    location = URL
+    for _ in range(5):  # follows a few redirections
+        response, connection = fetch_response(fetcher, location, headers)
+        if response.status not in (301, 302, 303, 307, 308):
+            break
+        response.read()
+        release_connection(fetcher, location, connection)
+        location = urllib.parse.urljoin(location,
+                                        response.getheader('Location'))
+    if response.status in (200, 304):
+        if (response.status == 200):
+            return FetchedPayload(fetcher, URL, location, response,
+                                  connection, digest)
+        response.read()
+        release_connection(fetcher, location, connection)
+        with fetcher.lock:
+            fetcher.stats['not_modified'] += 1
+        return None
+    response.read()
+    release_connection(fetcher, location, connection)
+    raise urllib.error.HTTPError(location, response.status, response.reason,
+                                 response.headers, None)
+
+
+def unchanged_payload(file):
+    """Returns True if a text stream returned by open_url with a fetcher has
+    been read to its end and its payload is the same as the last time it
+    was fetched, which happens with servers that send no validators.
+    ------------------------------------------------------------------------
+    Keyword arguments:
+    file -- Text stream of the data of a URL.
+    """
+
+    return getattr(getattr(file.buffer, 'raw', None), 'unchanged', False)
+
+
+def open_url(URL, fetcher=None):
+    """Returns a text stream that decodes incrementally the data of a URL, so
+    it is read while it is downloaded, or None if a fetcher is given and the
+    server tells the data has not changed since the last time (the servers
+    without validators are checked with unchanged_payload once it is read).
+    -------------------------------------------------------------------------
+    Keyword arguments:
+    URL -- The URL, file:// URL or name of a local (or gzip compressed)
+           file we want to read.
+    fetcher -- Fetcher used to download the URL. If it is given, the data is
+               only downloaded if it has changed.
+    """
+
+    if URL.startswith('file://') or '://' not in URL:
+        if URL.startswith('file://'):
+            URL = urllib.request.url2pathname(URL[len('file://'):])
+        if URL.endswith('.gz'):
+            binary = gzip.open(URL, 'rb')
+        else:
+            binary = open(URL, 'rb')
+    elif fetcher is not None:
+        payload = fetch(fetcher, URL)
+        if payload is None:
+            return None
+        binary = io.BufferedReader(payload)
+    else:
+        binary = urllib.request.urlopen(URL)
+    # a wrong byte only spoils its own row
+    return io.TextIOWrapper(binary, encoding='utf-8', errors='replace',
+                            newline='')
+
+
+def count_row(stats, valid):
+    """Counts a row read from the data of a URL and if it was skipped.
+    ------------------------------------------------------------------
+    Keyword arguments:
+    stats -- Dictionary where we count the rows, or None.
+    valid -- If it is False, the row was skipped.
+    """
+
+    if stats is not None:
+        stats['rows'] = stats.get('rows', 0) + 1
+        if not valid:
+            stats['skipped'] = stats.get('skipped', 0) + 1
+
+
+def parse_highway(line):
+    """Returns the highway of a row of the highways data, or None if the row
+    is malformed.
+    ------------------------------------------------------------------------
+    Keyword arguments:
+    line -- List of fields (way_id, description, coordinates) of the row.
+    """
+
+    if (len(line) != 3):
+        return None
+    way_id, description, coordinates = line
+    try:
+        int(way_id)
+        coordinates = fix_coordinates(coordinates)
+    except ValueError:
+        return None
+    # a highway needs at least two finite points
+    if (len(coordinates) < 2 or not np.isfinite(coordinates).all()):
+        return None
+    return Highway(way_id, description, coordinates)
+
+
+def download_highways(HIGHWAYS_URL, stats=None, fetcher=None):
+    """Downloads highways data from a URL, skipping the malformed rows. If a
+    fetcher is given, it returns None when the data has not changed.
+    ------------------------------------------------------------------------
+    Keyword arguments:
+    HIGHWAYS_URL -- The URL, or local file, where we want to download the
+                    highways data from.
+    stats -- Dictionary where we want to count the rows read and skipped.
+    fetcher -- Fetcher used to download the data.
+    """
+
+    file = open_url(HIGHWAYS_URL, fetcher)
+    if file is None:
+        return None
+    with file:
+        reader = csv.reader(file, delimiter=',', quotechar='"')
+        next(reader, None)  # ignore first line with description
         highways = []
         for line in reader:
-            way_id, description, coordinates = line
-            coordinates = fix_coordinates(coordinates)
-            highways.append(Highway(way_id, description, coordinates))
+            highway = parse_highway(line)
+            count_row(stats, highway is not None)
+            if highway is not None:
+                highways.append(highway)
+        # the payload is only known to be the same once it is read
+        if unchanged_payload(file):
+            return None
     return highways
 
 
-def plot_highways(highways, png, SIZE):
+def plot_highways(highways, png, SIZE, basemap=None, tile_cache=None,
+                  format='PNG', options=None):
     """Plots the highways we give as an argument and saves them as a png file.
     --------------------------------------------------------------------------
     Keyword arguments:
     highways -- List of highways we want to plot.
-    png -- File where we want to save the in PNG format.
+    png -- File, or buffer, where we want to save the image.
     SIZE -- Size of the map where we want to plot the highways to.
+    basemap -- Basemap used as background instead of the map tiles.
+    tile_cache -- Tile cache where the map tiles are looked up.
+    format -- Format of the image (PNG, JPEG or WEBP).
+    options -- Dictionary with the encoding options of the format.
     """
 
-    map = StaticMap(SIZE, SIZE)
-    for highway in highways:
-        line = Line(highway.coordinates, 'red', 3)
-        map.add_line(line)
-    image = map.render()
-    image.save(png)
+    lines = [(highway.coordinates, 'red', 3) for highway in highways]
+    image = render_map(SIZE, lines, [], basemap, tile_cache)
+    encode_image(image, png, format, options)
 
 
-def download_congestions(CONGESTIONS_URL):
-    """Downloads congestions data from a URL.
-    -----------------------------------------
+def fix_date(date):
+    """Returns the timestamp, in seconds, of a congestion date.
+    -----------------------------------------------------------
     Keyword arguments:
-    CONGESTIONS_URL -- The URL where we want to download the congestions data
-    from.
+    date -- Date of a congestion with the format YYYYmmddHHMMSS.
     """
 
-    with urllib.request.urlopen(CONGESTIONS_URL) as response:
-        lines = [l.decode('utf-8') for l in response.readlines()]
-        reader = csv.reader(lines, delimiter='#', quotechar='"')
-        congestions = []
-        for line in reader:
-            way_id, date, actual_state, planned_state = line
-            congestions.append(Congestion(way_id, date, actual_state))
+    try:
+        return int(datetime.strptime(date, '%Y%m%d%H%M%S').timestamp())
+    except:
+        return 0  # unknown date
+
+
+# the congestions arrays are indexed by way_id, so the way_ids over this
+# bound (the city ones are a few hundreds) are skipped instead of making
+# them huge
+MAX_WAY_ID = 2**20
+
+
+def build_congestions(rows):
+    """Returns the congestions data stored in arrays indexed by way_id.
+    -------------------------------------------------------------------
+    Keyword arguments:
+    rows -- List of (way_id, date, actual_state, planned_state) integers.
+    """
+
+    size = max([row[0] for row in rows], default=-1) + 1
+    # state 0 (without data) is kept for the highways that are not given
+    congestions = Congestions(np.zeros(size, dtype=np.uint8),
+                              np.zeros(size, dtype=np.uint8),
+                              np.zeros(size, dtype=np.int64))
+    for way_id, date, actual_state, planned_state in rows:
+        congestions.actual[way_id] = actual_state
+        congestions.planned[way_id] = planned_state
+        congestions.date[way_id] = date
     return congestions
 
 
+def parse_congestion(line):
+    """Returns the (way_id, date, actual_state, planned_state) integers of a
+    row of the congestions data, or None if the row is malformed.
+    ------------------------------------------------------------------------
+    Keyword arguments:
+    line -- List of fields (way_id, date, actual_state, planned_state) of the
+            row.
+    """
+
+    if (len(line) != 4):
+        return None
+    way_id, date, actual_state, planned_state = line
+    try:
+        row = (int(way_id), fix_date(date), int(actual_state),
+               int(planned_state))
+    except ValueError:
+        return None
+    # the way_ids index the congestions arrays and the states go from 0
+    # (without data) to 6 (cut)
+    if not (0 <= row[0] <= MAX_WAY_ID and 0 <= row[2] <= 6
+            and 0 <= row[3] <= 6):
+        return None
+    return row
+
+
+def download_congestions(CONGESTIONS_URL, stats=None, fetcher=None):
+    """Downloads congestions data from a URL, skipping the malformed rows. If
+    a fetcher is given, it returns None when the data has not changed.
+    -------------------------------------------------------------------------
+    Keyword arguments:
+    CONGESTIONS_URL -- The URL, or local file, where we want to download the
+                       congestions data from.
+    stats -- Dictionary where we want to count the rows read and skipped.
+    fetcher -- Fetcher used to download the data.
+    """
+
+    file = open_url(CONGESTIONS_URL, fetcher)
+    if file is None:
+        return None
+    with file:
+        reader = csv.reader(file, delimiter='#', quotechar='"')
+        rows = []
+        for line in reader:
+            row = parse_congestion(line)
+            count_row(stats, row is not None)
+            if row is not None:
+                rows.append(row)
+        # the payload is only known to be the same once it is read
+        if unchanged_payload(file):
+            return None
+    return build_congestions(rows)
+
+
 def congestion_state(state):
     """Provides the line colour in function of the congestion level of the
     highway.
@@ -162,45 +639,46 @@ def congestion_state(state):
     state -- Actual congestion of a certain highway.
     """
 
-    if (state == '0'):  # without data
+    state = int(state)
+    if (state == 0):  # without data
         return 'gray'
-    if (state == '1'):  # very fluid
+    if (state == 1):  # very fluid
         return 'cornflowerblue'
-    if (state == '2'):  # fluid
+    if (state == 2):  # fluid
         return 'limegreen'
-    if (state == '3'):  # dense
+    if (state == 3):  # dense
         return 'khaki'
-    if (state == '4'):  # very dense
+    if (state == 4):  # very dense
         return 'orangered'
-    if (state == '5'):  # congestion
+    if (state == 5):  # congestion
         return 'red'
-    if (state == '6'):  # cut
+    if (state == 6):  # cut
         return 'black'
     return None
 
 
-def plot_congestions(highways, congestions, png, SIZE):
+def plot_congestions(highways, congestions, png, SIZE, basemap=None,
+                     tile_cache=None, format='PNG', options=None):
     """Plots the congestion of every highway in the graph in a certain day and
     hour, and saves the result as a png file.
     --------------------------------------------------------------------------
     Keyword arguments:
     highways -- List of highways we want to plot.
-    congestions -- List of congestions we want to plot.
-    png -- File where we want to save the in PNG format.
+    congestions -- Congestions data we want to plot.
+    png -- File, or buffer, where we want to save the image.
     SIZE -- Size of the map where we want to plot the congestions.
+    basemap -- Basemap used as background instead of the map tiles.
+    tile_cache -- Tile cache where the map tiles are looked up.
+    format -- Format of the image (PNG, JPEG or WEBP).
+    options -- Dictionary with the encoding options of the format.
     """
 
-    map = StaticMap(SIZE, SIZE)
+    lines = []
     for highway in highways:
-        id = int(highway.way_id)
-        try:
-            colour = congestion_state(congestions[id].state)
-            line = Line(highway.coordinates, colour, 3)
-            map.add_line(line)
-        except:
-            None
-    image = map.render()
-    image.save(png)
+        state = highway_state(congestions, int(highway.way_id))
+        lines.append((highway.coordinates, congestion_state(state), 3))
+    image = render_map(SIZE, lines, [], basemap, tile_cache)
+    encode_image(image, png, format, options)
 
 
 def congestion(state):
@@ -210,22 +688,376 @@ def congestion(state):
     state -- Actual congestion of a certain highway.
     """
 
-    if (state == '1'):
+    state = int(state)
+    if (state == 1):
         congestion = 1
-    elif (state == '2' or state == '0'):
+    elif (state == 2 or state == 0):
         congestion = 0.8
-    elif (state == '3'):
+    elif (state == 3):
         congestion = 0.6
-    elif (state == '4'):
+    elif (state == 4):
         congestion = 0.4
-    elif (state == '5'):
+    elif (state == 5):
         congestion = 0.2
-    elif (state == '6'):
+    elif (state == 6):
         congestion = 0
     return congestion
 
 
-def build_igraph(graph, highways, congestions):
+# congestion value of every state, so it can be applied to arrays of states
+CONGESTION_VALUES = np.array([congestion(state) for state in range(7)])
+
+
+def highway_state(congestions, way_id):
+    """Returns the actual congestion state of a certain highway.
+    ------------------------------------------------------------
+    Keyword arguments:
+    congestions -- Congestions data for every highway.
+    way_id -- Identifier of the highway we want the state from.
+    """
+
+    if (0 <= way_id < len(congestions.actual)):
+        return int(congestions.actual[way_id])
+    return 0  # no data
+
+
+def edge_speed(edge):
+    """Returns the maximum speed of an edge.
+    ----------------------------------------
+    Keyword arguments:
+    edge -- Attributes of the edge we want the speed from.
+    """
+
+    try:
+        return float(edge['maxspeed'])
+    except:
+        # we set 20 km/h as standard speed if no speed is given
+        return 20
+
+
+def edge_itime(edge, congestion):
+    """Returns the itime of an edge given the congestion value of its highway.
+    -------------------------------------------------------------------------
+    Keyword arguments:
+    edge -- Attributes of the edge we want the itime from.
+    congestion -- Congestion value that will be applied to the edge speed.
+    """
+
+    length = float(edge['length'])
+    speed = edge_speed(edge)
+    # a cut street can not be crossed in any finite time
+    if (congestion == 0):
+        return float('inf')
+    return length/(speed*congestion)
+
+
+def project_coordinates(longitudes, latitudes, latitude):
+    """Returns the coordinates, in meters, of a list of points projected with
+    an equirectangular projection, which is accurate enough for a city.
+    -------------------------------------------------------------------------
+    Keyword arguments:
+    longitudes -- Longitudes of the points.
+    latitudes -- Latitudes of the points.
+    latitude -- Reference latitude of the projection.
+    """
+
+    EARTH_RADIUS = 6371009
+    x = np.radians(longitudes)*np.cos(np.radians(latitude))*EARTH_RADIUS
+    y = np.radians(latitudes)*EARTH_RADIUS
+    return np.column_stack([x, y])
+
+
+def node_coordinates(graph):
+    """Returns the arrays of nodes, longitudes and latitudes of a graph.
+    --------------------------------------------------------------------
+    Keyword arguments:
+    graph -- Graph, or routing data, we want the coordinates from.
+    """
+
+    if isinstance(graph, RoutingData):
+        csr = graph.csr
+        return csr.nodes, csr.x, csr.y
+    nodes = np.array(list(graph.nodes))
+    longitudes = np.array([graph.nodes[node]['x'] for node in nodes])
+    latitudes = np.array([graph.nodes[node]['y'] for node in nodes])
+    return nodes, longitudes, latitudes
+
+
+def build_spatial_index(graph):
+    """Returns a spatial index to find the nearest nodes of a graph.
+    ----------------------------------------------------------------
+    Keyword arguments:
+    graph -- Graph, or routing data, whose nodes we want to index.
+    """
+
+    nodes, longitudes, latitudes = node_coordinates(graph)
+    latitude = float(np.mean(latitudes)) if len(nodes) else 0.0
+    points = project_coordinates(longitudes, latitudes, latitude)
+    return SpatialIndex(cKDTree(points), nodes, latitude)
+
+
+def save_spatial_index(spatial_index, SPATIAL_INDEX_FILENAME):
+    """Saves a spatial index in a determined file.
+    ----------------------------------------------
+    Keyword arguments:
+    spatial_index -- Spatial index we want to save.
+    SPATIAL_INDEX_FILENAME -- Name that we give to the file where we save the
+                              spatial index.
+    """
+
+    with open(SPATIAL_INDEX_FILENAME, 'wb') as file:
+        pickle.dump(spatial_index, file)
+
+
+def load_spatial_index(SPATIAL_INDEX_FILENAME, graph=None):
+    """Loads a spatial index from a determined file. If a graph is given,
+    the index is built and saved again when the file is missing or it
+    indexes the nodes of another graph.
+    ---------------------------------------------------------------------
+    Keyword arguments:
+    SPATIAL_INDEX_FILENAME -- Name of the file we are loading the spatial
+                              index from.
+    graph -- Graph, or routing data, that the index has to match.
+    """
+
+    spatial_index = None
+    if graph is None or os.path.exists(SPATIAL_INDEX_FILENAME):
+        with open(SPATIAL_INDEX_FILENAME, 'rb') as file:
+            spatial_index = pickle.load(file)
+    if graph is None:
+        return spatial_index
+    # an index of a graph that has been rebuilt finds nodes it does not have
+    nodes = node_coordinates(graph)[0]
+    if (spatial_index is None or
+            not np.array_equal(spatial_index.nodes, nodes)):
+        spatial_index = build_spatial_index(graph)
+        save_spatial_index(spatial_index, SPATIAL_INDEX_FILENAME)
+    return spatial_index
+
+
+def nearest_nodes(spatial_index, longitudes, latitudes):
+    """Returns the nearest node of the graph to every given point. If a single
+    point is given, a single node is returned.
+    -------------------------------------------------------------------------
+    Keyword arguments:
+    spatial_index -- Spatial index of the graph.
+    longitudes -- Longitude or array of longitudes of the points.
+    latitudes -- Latitude or array of latitudes of the points.
+    """
+
+    points = project_coordinates(np.atleast_1d(longitudes),
+                                 np.atleast_1d(latitudes),
+                                 spatial_index.latitude)
+    distances, positions = spatial_index.tree.query(points)
+    nodes = spatial_index.nodes[positions]
+    if np.ndim(longitudes) == 0:
+        return nodes[0].item()
+    return nodes.tolist()
+
+
+# graph whose highways are matched by the processes of a pool, which get it
+# once when they are forked
+matching_graph = None
+
+
+def match_highway(nodes, graph=None):
+    """Returns the list of directed edges, in order, of the shortest paths
+    between every two consecutive nodes of a highway.
+    ----------------------------------------------------------------------
+    Keyword arguments:
+    nodes -- Nearest node of every point of the highway.
+    graph -- Graph where we want to match the highway. If it is not given,
+             the graph kept by the process is used.
+    """
+
+    if graph is None:
+        graph = matching_graph
+    edges = []
+    for node1, node2 in zip(nodes, nodes[1:]):
+        shortest_path = ox.shortest_path(graph, node1, node2)
+        # some highways are from outside of Barcelona
+        if shortest_path is not None:
+            edges.extend(zip(shortest_path, shortest_path[1:]))
+    return edges
+
+
+def build_highway_edges(graph, highways, spatial_index=None, processes=None):
+    """Returns a dictionary that maps the identifier of every highway to the
+    list of directed edges of the graph that it covers.
+    ------------------------------------------------------------------------
+    Keyword arguments:
+    graph -- Graph where we want to match the highways.
+    highways -- List that contains the highways data for a certain place.
+    spatial_index -- Spatial index of the graph. If it is not given, it is
+                     built from the graph.
+    processes -- Number of processes that match the highways. If it is not
+                 given, they are matched in this process.
+    """
+
+    global matching_graph
+    if spatial_index is None:
+        spatial_index = build_spatial_index(graph)
+    # we find at once the nearest node of every point of every highway
+    highway_nodes = []
+    if highways:
+        coordinates = np.concatenate([np.asarray(highway.coordinates,
+                                                 dtype=float).reshape(-1, 2)
+                                      for highway in highways])
+        longitudes, latitudes = coordinates.T
+        nodes = iter(nearest_nodes(spatial_index, longitudes, latitudes))
+        highway_nodes = [[next(nodes) for _ in highway.coordinates]
+                         for highway in highways]
+
+    # the shortest paths of every highway are found apart, in its order, so
+    # the pool returns the same edges as the serial matching
+    if processes is None or len(highways) < 2:
+        matched = [match_highway(nodes, graph) for nodes in highway_nodes]
+    else:
+        matching_graph = graph
+        context = multiprocessing.get_context('fork')
+        chunksize = max(1, len(highways) // (4*processes))
+        try:
+            with concurrent.futures.ProcessPoolExecutor(processes,
+                                                        context) as executor:
+                matched = list(executor.map(match_highway, highway_nodes,
+                                            chunksize=chunksize))
+        finally:
+            matching_graph = None
+
+    # every edge belongs to the last highway that covers it, as this is the
+    # one whose congestion ends up being applied to it
+    edge_owners = {}
+    highway_edges = {}
+    for highway, edges in zip(highways, matched):
+        way_id = int(highway.way_id)
+        highway_edges[way_id] = []
+        for edge in edges:
+            edge_owners[edge] = way_id
+
+    for edge, way_id in edge_owners.items():
+        highway_edges[way_id].append(edge)
+    return highway_edges
+
+
+def graph_signature(GRAPH_FILENAME):
+    """Returns the digest of the file of a saved graph, which tells apart
+    the graphs downloaded at different times.
+    ---------------------------------------------------------------------
+    Keyword arguments:
+    GRAPH_FILENAME -- Name of the file of the pickled graph.
+    """
+
+    digest = hashlib.sha256()
+    with open(GRAPH_FILENAME, 'rb') as file:
+        for chunk in iter(lambda: file.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def save_highway_edges(highway_edges, HIGHWAY_EDGES_FILENAME,
+                       signature=None):
+    """Saves the highway-to-edges mapping in a determined file.
+    -----------------------------------------------------------
+    Keyword arguments:
+    highway_edges -- Dictionary that maps every highway to its edges.
+    HIGHWAY_EDGES_FILENAME -- Name that we give to the file where we save the
+                              mapping.
+    signature -- Signature of the graph file whose edges are mapped.
+    """
+
+    with open(HIGHWAY_EDGES_FILENAME, 'wb') as file:
+        pickle.dump((signature, highway_edges), file)
+
+
+def load_highway_edges(HIGHWAY_EDGES_FILENAME, signature=None):
+    """Loads the highway-to-edges mapping from a determined file. If the
+    signature of a graph file is given, it returns None when the mapping
+    was built from another graph, as its edges may be gone.
+    --------------------------------------------------------------------
+    Keyword arguments:
+    HIGHWAY_EDGES_FILENAME -- Name of the file we are loading the mapping
+                              from.
+    signature -- Signature of the graph file the mapping has to match.
+    """
+
+    with open(HIGHWAY_EDGES_FILENAME, 'rb') as file:
+        saved = pickle.load(file)
+    # the mappings saved without signature are a plain dictionary
+    if isinstance(saved, dict):
+        saved = (None, saved)
+    saved_signature, highway_edges = saved
+    if signature is not None and signature != saved_signature:
+        return None
+    return highway_edges
+
+
+def build_edge_arrays(igraph, highway_edges):
+    """Returns the length, speed and highway of every edge of a directed
+    graph stored in arrays, following the order of igraph.edges.
+    --------------------------------------------------------------------
+    Keyword arguments:
+    igraph -- Directed graph we want the edge arrays from.
+    highway_edges -- Mapping from every highway to its edges.
+    """
+
+    edges = []
+    lengths = []
+    speeds = []
+    for node1, node2, edge in igraph.edges(data=True):
+        edges.append((node1, node2))
+        lengths.append(float(edge['length']))
+        speeds.append(edge_speed(edge))
+
+    # -1 is kept for the edges that are not covered by any highway
+    positions = {edge: position for position, edge in enumerate(edges)}
+    way_ids = np.full(len(edges), -1, dtype=np.int64)
+    for way_id, highway in highway_edges.items():
+        for edge in highway:
+            way_ids[positions[edge]] = way_id
+
+    return EdgeArrays(edges, np.array(lengths), np.array(speeds), way_ids)
+
+
+def compute_itimes(edge_arrays, congestions, planned=False):
+    """Returns an array with the itime of every edge of the edge arrays.
+    --------------------------------------------------------------------
+    Keyword arguments:
+    edge_arrays -- Edge arrays of the igraph.
+    congestions -- Congestions data for every highway.
+    planned -- If it is True, the planned state (15 minutes later) is
+               applied instead of the actual one.
+    """
+
+    # the edges without highway or without data get the state 0
+    way_ids = edge_arrays.way_ids
+    highway_states = congestions.planned if planned else congestions.actual
+    known = (way_ids >= 0) & (way_ids < len(highway_states))
+    states = np.zeros(len(way_ids), dtype=np.uint8)
+    states[known] = highway_states[way_ids[known]]
+
+    values = CONGESTION_VALUES[states]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        itimes = edge_arrays.lengths/(edge_arrays.speeds*values)
+    # a cut street can not be crossed in any finite time
+    itimes[values == 0] = np.inf
+    return itimes
+
+
+def set_itimes(igraph, edge_arrays, itimes):
+    """Sets at once the itime attribute of every edge of the igraph.
+    ----------------------------------------------------------------
+    Keyword arguments:
+    igraph -- Directed graph where we want to set the itimes.
+    edge_arrays -- Edge arrays of the igraph.
+    itimes -- Array with the itime of every edge.
+    """
+
+    itimes = dict(zip(edge_arrays.edges, itimes.tolist()))
+    nx.set_edge_attributes(igraph, itimes, 'itime')
+
+
+def build_igraph(graph, highways, congestions, highway_edges=None,
+                 edge_arrays=None, processes=None):
     """Returns a directed graph, from an undirected one, with intelligent
     attributes.
     ---------------------------------------------------------------------
@@ -233,72 +1065,1316 @@ def build_igraph(graph, highways, congestions):
     graph -- Undirected graph based on which we will construct the
              intelligent graph.
     highways -- List that contains the highways data for a certain place.
-    congestions -- List that contains the congestion data for every highway.
+    congestions -- Congestions data for every highway.
+    highway_edges -- Precomputed mapping from every highway to its edges. If
+                     it is not given, it is computed from the highways.
+    edge_arrays -- Precomputed edge arrays of the igraph. If they are given,
+                   all the itimes are computed at once with NumPy.
+    processes -- Number of processes that match the highways, if the
+                 mapping is not given.
     """
 
     igraph = get_digraph(graph)
+    if edge_arrays is not None:
+        set_itimes(igraph, edge_arrays, compute_itimes(edge_arrays,
+                                                       congestions))
+        return igraph
+
     nx.set_edge_attributes(igraph, None, 'itime')
+    if highway_edges is None:
+        highway_edges = build_highway_edges(igraph, highways,
+                                            processes=processes)
 
-    for highway in highways:
-        x_coordinate, y_coordinate = highway.coordinates[0]
-        node1 = ox.nearest_nodes(igraph, x_coordinate, y_coordinate)
-        for x_coordinate, y_coordinate in highway.coordinates[1:]:
-            node2 = ox.nearest_nodes(igraph, x_coordinate, y_coordinate)
-
-            # some highways are from outside of Barcelona
-            try:
-                shortest_path = ox.shortest_path(igraph, node1, node2)
-                point1 = shortest_path[0]
-                for point2 in shortest_path[1:]:
-                    edge = igraph[point1][point2]
-                    length = float(edge['length'])
-                    try:
-                        speed = float(edge['maxspeed'])
-                    except:
-                        # we set 20 km/h as standard speed if no speed is given
-                        speed = 20
-                    try:
-                        id = int(highway.way_id)
-                        state = congestions[id].state
-                    except:
-                        state = '0'  # no data
-                    congestion = congestion(state)
-                    edge['itime'] = length/(speed*congestion)
-                    point1 = point2
-            except:
-                None
-
-            node1 = node2
+    for way_id, edges in highway_edges.items():
+        value = congestion(highway_state(congestions, way_id))
+        for node1, node2 in edges:
+            edge = igraph[node1][node2]
+            edge['itime'] = edge_itime(edge, value)
 
     for node1, info in igraph.nodes.items():
         for node2, edge in igraph.adj[node1].items():
             if (edge['itime'] is None):
-                length = float(edge['length'])
-                try:
-                    speed = float(edge['maxspeed'])
-                except:
-                    speed = 20
-                edge['itime'] = length/(speed*0.8)
+                edge['itime'] = edge_itime(edge, 0.8)
 
     return igraph
 
 
-def get_node(graph, location):
+def refresh_igraph(igraph, highway_edges, old_congestions, new_congestions):
+    """Updates in place the itime of the edges whose highway changed its
+    congestion state, and returns how many edges were touched.
+    --------------------------------------------------------------------
+    Keyword arguments:
+    igraph -- Intelligent graph built with the old congestions.
+    highway_edges -- Mapping from every highway to its edges.
+    old_congestions -- Congestion data the igraph was built with.
+    new_congestions -- Congestion data we want to apply to the igraph.
+    """
+
+    touched = 0
+    for way_id, edges in highway_edges.items():
+        state = highway_state(new_congestions, way_id)
+        # most highways keep their state between downloads
+        if (state == highway_state(old_congestions, way_id)):
+            continue
+        value = congestion(state)
+        for node1, node2 in edges:
+            edge = igraph[node1][node2]
+            edge['itime'] = edge_itime(edge, value)
+        touched += len(edges)
+    return touched
+
+
+def build_csr(igraph, weight='itime'):
+    """Returns the compressed sparse row layout of a directed graph. Its edges
+    follow the order of igraph.edges, so the weights can be replaced by an
+    array of itimes computed from the edge arrays.
+    -------------------------------------------------------------------------
+    Keyword arguments:
+    igraph -- Directed graph we want to freeze.
+    weight -- Name of the edge attribute used as weight.
+    """
+
+    nodes = list(igraph.nodes)
+    index = {node: position for position, node in enumerate(nodes)}
+    x = np.array([igraph.nodes[node]['x'] for node in nodes])
+    y = np.array([igraph.nodes[node]['y'] for node in nodes])
+
+    # igraph.edges visits the edges grouped by source node, in node order
+    degrees = [degree for node, degree in igraph.out_degree(nodes)]
+    offsets = np.zeros(len(nodes) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(degrees)
+    targets = np.array([index[node2] for node1, node2 in igraph.edges],
+                       dtype=np.int64)
+    weights = np.array([value for node1, node2, value
+                        in igraph.edges(data=weight)], dtype=np.float64)
+    lengths = np.array([float(value) for node1, node2, value
+                        in igraph.edges(data='length')])
+
+    return Csr(np.array(nodes), index, x, y, offsets, targets, weights,
+               lengths)
+
+
+def csr_lists(csr, planned=None, previous=None):
+    """Returns the plain lists of a compressed sparse row layout and of its
+    planned itimes, together with the maximum effective speed of its edges.
+    -----------------------------------------------------------------------
+    Keyword arguments:
+    csr -- Compressed sparse row layout of the graph.
+    planned -- Array with the planned itime of every edge, or None.
+    previous -- Lists of another version of the weights of the same layout,
+                whose offsets and targets are reused.
+    """
+
+    if previous is None:
+        offsets = csr.offsets.tolist()
+        targets = csr.targets.tolist()
+    else:
+        offsets, targets = previous.offsets, previous.targets
+    return CsrLists(offsets, targets, csr.weights.tolist(),
+                    None if planned is None else planned.tolist(),
+                    max_speed(csr))
+
+
+def potential_function(potentials):
+    """Returns a function of the index of a node that gives the lower bound
+    of its distance to the target of a search, or None if there is none.
+    -----------------------------------------------------------------------
+    Keyword arguments:
+    potentials -- Array with the lower bound of every node, a function that
+                  computes it or None.
+    """
+
+    if potentials is None or callable(potentials):
+        return potentials
+    return lambda node: float(potentials[node])
+
+
+def csr_shortest_path(csr, source, target, potentials=None, stats=None,
+                      lists=None):
+    """Returns a list of nodes that represents the shortest path between two
+    nodes of a compressed sparse row graph, or None if there is no path.
+    ------------------------------------------------------------------------
+    Keyword arguments:
+    csr -- Compressed sparse row layout of the graph.
+    source -- Node from which we want to start the path.
+    target -- Node that we want to reach.
+    potentials -- Lower bound of the distance from every node to the target,
+                  as an array or a function of the index of a node. If they
+                  are given, an A* search is done instead of a Dijkstra one.
+    stats -- Dictionary where we want to save the number of settled nodes.
+    lists -- Lists of the layout. If they are not given, they are built for
+             this search.
+    """
+
+    source = csr.index[source]
+    target = csr.index[target]
+    if lists is None:
+        lists = csr_lists(csr)
+    offsets, targets, weights = lists.offsets, lists.targets, lists.weights
+    # the lower bounds are only computed for the nodes reached
+    potential = potential_function(potentials)
+    estimates = {}
+
+    distances = {source: 0.0}
+    previous = {}
+    settled = set()
+    heap = [(0.0, source)]
+    while heap:
+        key, node1 = heapq.heappop(heap)
+        if node1 in settled:
+            continue
+        settled.add(node1)
+        if (node1 == target):
+            break
+        distance = distances[node1]
+        for position in range(offsets[node1], offsets[node1 + 1]):
+            node2 = targets[position]
+            new_distance = distance + weights[position]
+            if (node2 not in distances or new_distance < distances[node2]):
+                distances[node2] = new_distance
+                previous[node2] = node1
+                key = new_distance
+                if potential is not None:
+                    estimate = estimates.get(node2)
+                    if estimate is None:
+                        estimate = estimates[node2] = potential(node2)
+                    key += estimate
+                heapq.heappush(heap, (key, node2))
+
+    if stats is not None:
+        stats['settled'] = len(settled)
+    if target not in settled:
+        return None
+    path = [target]
+    while path[-1] != source:
+        path.append(previous[path[-1]])
+    return [csr.nodes[node].item() for node in reversed(path)]
+
+
+def reverse_csr(offsets, targets, weights):
+    """Returns the offsets, targets and weights of the reversed graph of a
+    compressed sparse row layout.
+    ----------------------------------------------------------------------
+    Keyword arguments:
+    offsets -- Offsets of the compressed sparse row layout.
+    targets -- Targets of the compressed sparse row layout.
+    weights -- Weights of the compressed sparse row layout.
+    """
+
+    sources = np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+    order = np.argsort(targets, kind='stable')
+    reversed_offsets = np.zeros(len(offsets), dtype=np.int64)
+    reversed_offsets[1:] = np.cumsum(np.bincount(targets,
+                                                 minlength=len(offsets) - 1))
+    return reversed_offsets, sources[order], weights[order]
+
+
+def csr_distances(offsets, targets, weights, source):
+    """Returns an array with the distance from a node to every node of a
+    compressed sparse row layout (infinite for the unreachable ones).
+    --------------------------------------------------------------------
+    Keyword arguments:
+    offsets -- Offsets of the compressed sparse row layout.
+    targets -- Targets of the compressed sparse row layout.
+    weights -- Weights of the compressed sparse row layout.
+    source -- Index of the node from which we want the distances.
+    """
+
+    offsets = offsets.tolist()
+    targets = targets.tolist()
+    weights = weights.tolist()
+    distances = [float('inf')] * (len(offsets) - 1)
+    distances[source] = 0.0
+    heap = [(0.0, source)]
+    while heap:
+        distance, node1 = heapq.heappop(heap)
+        if (distance > distances[node1]):
+            continue
+        for position in range(offsets[node1], offsets[node1 + 1]):
+            node2 = targets[position]
+            new_distance = distance + weights[position]
+            if (new_distance < distances[node2]):
+                distances[node2] = new_distance
+                heapq.heappush(heap, (new_distance, node2))
+    return np.array(distances)
+
+
+def one_to_many(offsets, targets, weights, lengths, source, goals):
+    """Returns the itime and the length of the shortest paths from a node to
+    some nodes of a compressed sparse row layout (infinite for the
+    unreachable ones). The search stops as soon as every goal is settled.
+    ------------------------------------------------------------------------
+    Keyword arguments:
+    offsets -- List of offsets of the compressed sparse row layout.
+    targets -- List of targets of the compressed sparse row layout.
+    weights -- List of weights of the compressed sparse row layout.
+    lengths -- List of lengths of the edges of the layout.
+    source -- Index of the node from which we want the paths.
+    goals -- List of indices of the nodes that we want to reach.
+    """
+
+    distances = {source: 0.0}
+    path_lengths = {source: 0.0}
+    pending = set(goals)
+    settled = set()
+    heap = [(0.0, source)]
+    while heap and pending:
+        distance, node1 = heapq.heappop(heap)
+        if node1 in settled:
+            continue
+        settled.add(node1)
+        pending.discard(node1)
+        for position in range(offsets[node1], offsets[node1 + 1]):
+            node2 = targets[position]
+            new_distance = distance + weights[position]
+            if (node2 not in distances or new_distance < distances[node2]):
+                distances[node2] = new_distance
+                path_lengths[node2] = path_lengths[node1] + lengths[position]
+                heapq.heappush(heap, (new_distance, node2))
+
+    infinity = float('inf')
+    return ([distances[goal] if goal in settled else infinity
+             for goal in goals],
+            [path_lengths[goal] if goal in settled else infinity
+             for goal in goals])
+
+
+# compressed sparse row layout of the processes that compute route matrices,
+# as lists so it is converted only once by every process
+matrix_layout = None
+
+
+def init_matrix_layout(offsets, targets, weights, lengths):
+    """Keeps the compressed sparse row layout of a process that computes
+    route matrices.
+    --------------------------------------------------------------------
+    Keyword arguments:
+    offsets -- Offsets of the compressed sparse row layout.
+    targets -- Targets of the compressed sparse row layout.
+    weights -- Weights of the compressed sparse row layout.
+    lengths -- Lengths of the edges of the layout.
+    """
+
+    global matrix_layout
+    matrix_layout = (offsets.tolist(), targets.tolist(), weights.tolist(),
+                     lengths.tolist())
+
+
+def matrix_rows(sources, goals):
+    """Returns the itime and length rows of some sources of a route matrix,
+    with the layout kept by the process.
+    -----------------------------------------------------------------------
+    Keyword arguments:
+    sources -- List of indices of the nodes from which we want the paths.
+    goals -- List of indices of the nodes that we want to reach.
+    """
+
+    return [one_to_many(*matrix_layout, source, goals) for source in sources]
+
+
+def csr_matrix(csr, sources, targets, processes=None):
+    """Returns two arrays with the itime and the length of the shortest path
+    from every source to every target of a compressed sparse row layout.
+    ------------------------------------------------------------------------
+    Keyword arguments:
+    csr -- Compressed sparse row layout of the graph.
+    sources -- List of nodes from which we want the paths.
+    targets -- List of nodes that we want to reach.
+    processes -- Number of processes among which the searches are shared.
+                 If it is None, they are done in this process.
+    """
+
+    sources = [csr.index[source] for source in sources]
+    targets = [csr.index[target] for target in targets]
+    # every distinct node is searched once, from the side with fewer nodes
+    # over the reversed layout if it is the targets one
+    unique_sources = sorted(set(sources))
+    unique_targets = sorted(set(targets))
+    layout = (csr.offsets, csr.targets, csr.weights, csr.lengths)
+    reverse = len(unique_targets) < len(unique_sources)
+    if reverse:
+        layout = (*reverse_csr(csr.offsets, csr.targets, csr.weights),
+                  reverse_csr(csr.offsets, csr.targets, csr.lengths)[2])
+        unique_sources, unique_targets = unique_targets, unique_sources
+
+    if processes is None:
+        init_matrix_layout(*layout)
+        rows = matrix_rows(unique_sources, unique_targets)
+    else:
+        chunks = [unique_sources[i::processes] for i in range(processes)]
+        with concurrent.futures.ProcessPoolExecutor(
+                processes, initializer=init_matrix_layout,
+                initargs=layout) as executor:
+            results = list(executor.map(matrix_rows, chunks,
+                                        [unique_targets] * processes))
+        rows = [None] * len(unique_sources)
+        for i, result in enumerate(results):
+            rows[i::processes] = result
+
+    itimes = np.array([row[0] for row in rows]).reshape(len(unique_sources),
+                                                        len(unique_targets))
+    path_lengths = np.array([row[1] for row in rows]).reshape(itimes.shape)
+    if reverse:
+        itimes, path_lengths = itimes.T, path_lengths.T
+        unique_sources, unique_targets = unique_targets, unique_sources
+    rows = np.searchsorted(unique_sources, sources)
+    columns = np.searchsorted(unique_targets, targets)
+    return (itimes[np.ix_(rows, columns)],
+            path_lengths[np.ix_(rows, columns)])
+
+
+def build_landmarks(csr, edge_arrays, count=8):
+    """Returns the landmarks used by the A* search with landmarks (ALT). The
+    distances are computed with the itime of every edge without congestion,
+    which is never greater than its actual itime, so the landmarks remain
+    valid whatever the congestions are and only need to be built once.
+    ------------------------------------------------------------------------
+    Keyword arguments:
+    csr -- Compressed sparse row layout of the igraph.
+    edge_arrays -- Edge arrays of the igraph.
+    count -- Number of landmarks we want.
+    """
+
+    lower_bounds = edge_arrays.lengths/(edge_arrays.speeds *
+                                        CONGESTION_VALUES.max())
+    reversed_layout = reverse_csr(csr.offsets, csr.targets, lower_bounds)
+
+    # every new landmark is the node farthest from the ones already chosen
+    nodes = []
+    forward = []
+    backward = []
+    farthest = np.zeros(len(csr.nodes))
+    node = 0
+    for _ in range(min(count, len(csr.nodes))):
+        nodes.append(node)
+        forward.append(csr_distances(csr.offsets, csr.targets, lower_bounds,
+                                     node))
+        backward.append(csr_distances(*reversed_layout, node))
+        distances = forward[-1] + backward[-1]
+        distances[np.isinf(distances)] = 0
+        farthest = distances if len(nodes) == 1 else np.minimum(farthest,
+                                                                distances)
+        node = int(np.argmax(farthest))
+
+    return Landmarks(np.array(nodes), np.array(forward), np.array(backward))
+
+
+def landmark_lists(landmarks):
+    """Returns the landmarks with their distances as plain lists, which are
+    much faster than arrays when read node by node. As the landmarks do not
+    depend on the congestions, they are only converted once.
+    -----------------------------------------------------------------------
+    Keyword arguments:
+    landmarks -- Landmarks of the igraph.
+    """
+
+    return landmarks._replace(forward=landmarks.forward.tolist(),
+                              backward=landmarks.backward.tolist())
+
+
+def landmark_potentials(landmarks, target):
+    """Returns a function of the index of a node that gives a lower bound of
+    its itime to a target, using the triangle inequality with every
+    landmark. It is only evaluated for the nodes that a search reaches.
+    ------------------------------------------------------------------------
+    Keyword arguments:
+    landmarks -- Landmarks of the igraph, with their distances as arrays or
+                 as lists (see landmark_lists).
+    target -- Index of the node that we want to reach.
+    """
+
+    rows = [(forward, float(forward[target]), backward,
+             float(backward[target]))
+            for forward, backward in zip(landmarks.forward,
+                                         landmarks.backward)]
+
+    def potential(node):
+        bound = 0.0
+        for forward, forward_target, backward, backward_target in rows:
+            # the bounds between unreachable nodes are not valid (nan), and
+            # they are skipped as every comparison with nan is false
+            lower = forward_target - float(forward[node])
+            if (lower > bound):
+                bound = lower
+            lower = float(backward[node]) - backward_target
+            if (lower > bound):
+                bound = lower
+        # we leave a small margin against rounding errors in the differences
+        return bound*(1 - 1e-9)
+    return potential
+
+
+def alt_shortest_path(csr, landmarks, source, target, stats=None,
+                      lists=None):
+    """Returns a list of nodes that represents the shortest path between two
+    nodes using an A* search with landmarks (ALT).
+    ------------------------------------------------------------------------
+    Keyword arguments:
+    csr -- Compressed sparse row layout of the igraph.
+    landmarks -- Landmarks of the igraph.
+    source -- Node from which we want to start the path.
+    target -- Node that we want to reach.
+    stats -- Dictionary where we want to save the number of settled nodes.
+    lists -- Lists of the layout, or None.
+    """
+
+    potentials = landmark_potentials(landmarks, csr.index[target])
+    return csr_shortest_path(csr, source, target, potentials, stats, lists)
+
+
+def build_geometries(igraph):
+    """Returns the coordinates of the geometry of every edge of a directed
+    graph, following the order of igraph.edges.
+    ----------------------------------------------------------------------
+    Keyword arguments:
+    igraph -- Directed graph we want the geometries from.
+    """
+
+    offsets = [0]
+    x = []
+    y = []
+    for node1, node2 in igraph.edges:
+        for longitude, latitude in path_coordinates(igraph, [node1, node2]):
+            x.append(longitude)
+            y.append(latitude)
+        offsets.append(len(x))
+    return Geometries(np.array(offsets, dtype=np.int64), np.array(x),
+                      np.array(y))
+
+
+def build_routing_data(graph, highway_edges, landmarks=8):
+    """Returns the routing-ready data of a graph: its compressed layout, edge
+    arrays, edge geometries and landmarks.
+    -------------------------------------------------------------------------
+    Keyword arguments:
+    graph -- Undirected graph of a determined place.
+    highway_edges -- Mapping from every highway to its edges.
+    landmarks -- Number of landmarks of the ALT search.
+    """
+
+    igraph = get_digraph(graph)
+    edge_arrays = build_edge_arrays(igraph, highway_edges)
+    # the weights are the itimes without congestion data
+    itimes = compute_itimes(edge_arrays, build_congestions([]))
+    csr = build_csr(igraph, weight='length')._replace(weights=itimes)
+    return RoutingData(csr, edge_arrays, build_geometries(igraph),
+                       build_landmarks(csr, edge_arrays, landmarks))
+
+
+def save_routing_data(routing_data, ROUTING_DIRECTORY):
+    """Saves the routing data as a directory of NumPy arrays.
+    ---------------------------------------------------------
+    Keyword arguments:
+    routing_data -- Routing data we want to save.
+    ROUTING_DIRECTORY -- Name of the directory where we save the arrays.
+    """
+
+    csr, edge_arrays, geometries, landmarks = routing_data
+    arrays = {
+        'nodes': csr.nodes.astype(np.int64),
+        'x': csr.x,
+        'y': csr.y,
+        'offsets': csr.offsets.astype(np.int64),
+        'targets': csr.targets.astype(np.int32),
+        'lengths': edge_arrays.lengths,
+        'speeds': edge_arrays.speeds,
+        'way_ids': edge_arrays.way_ids.astype(np.int32),
+        'geometry_offsets': geometries.offsets,
+        'geometry_x': geometries.x,
+        'geometry_y': geometries.y,
+        'landmarks': landmarks.nodes.astype(np.int32),
+        'forward': landmarks.forward,
+        'backward': landmarks.backward,
+    }
+    os.makedirs(ROUTING_DIRECTORY, exist_ok=True)
+    for name, array in arrays.items():
+        np.save(os.path.join(ROUTING_DIRECTORY, name + '.npy'),
+                np.ascontiguousarray(array))
+
+
+def load_routing_data(ROUTING_DIRECTORY):
+    """Loads the routing data from a directory of NumPy arrays. The arrays
+    are memory-mapped read-only, so they are loaded in a few milliseconds
+    and shared by every process that loads them.
+    ----------------------------------------------------------------------
+    Keyword arguments:
+    ROUTING_DIRECTORY -- Name of the directory we are loading the arrays
+                         from.
+    """
+
+    arrays = {}
+    for filename in os.listdir(ROUTING_DIRECTORY):
+        name, extension = os.path.splitext(filename)
+        if (extension == '.npy'):
+            arrays[name] = np.load(os.path.join(ROUTING_DIRECTORY, filename),
+                                   mmap_mode='r')
+
+    # the edges are not stored, as they are only needed to build an igraph
+    edge_arrays = EdgeArrays(None, arrays['lengths'], arrays['speeds'],
+                             arrays['way_ids'])
+    index = dict(zip(arrays['nodes'].tolist(), range(len(arrays['nodes']))))
+    csr = Csr(arrays['nodes'], index, arrays['x'], arrays['y'],
+              arrays['offsets'], arrays['targets'],
+              compute_itimes(edge_arrays, build_congestions([])),
+              arrays['lengths'])
+    geometries = Geometries(arrays['geometry_offsets'], arrays['geometry_x'],
+                            arrays['geometry_y'])
+    landmarks = Landmarks(arrays['landmarks'], arrays['forward'],
+                          arrays['backward'])
+    return RoutingData(csr, edge_arrays, geometries, landmarks)
+
+
+def save_weights(weights, WEIGHTS_DIRECTORY, version, name='weights'):
+    """Publishes a version of the weights of the routing data as a NumPy
+    array and returns the name of its file. The file is written aside and
+    renamed, so it is never read half-written.
+    ---------------------------------------------------------------------
+    Keyword arguments:
+    weights -- Array of the weights, aligned with the edges of the routing
+               data.
+    WEIGHTS_DIRECTORY -- Name of the directory where we save the weights.
+    version -- Number of the version of the weights.
+    name -- Name of the kind of weights (the actual ones, or the planned
+            ones).
+    """
+
+    os.makedirs(WEIGHTS_DIRECTORY, exist_ok=True)
+    WEIGHTS_FILENAME = os.path.join(WEIGHTS_DIRECTORY,
+                                    '%s-%d.npy' % (name, version))
+    with open(WEIGHTS_FILENAME + '.tmp', 'wb') as file:
+        np.save(file, np.ascontiguousarray(weights, dtype=np.float64))
+    os.replace(WEIGHTS_FILENAME + '.tmp', WEIGHTS_FILENAME)
+    return WEIGHTS_FILENAME
+
+
+def load_weights(WEIGHTS_FILENAME):
+    """Loads a version of the weights of the routing data, memory-mapped
+    read-only.
+    --------------------------------------------------------------------
+    Keyword arguments:
+    WEIGHTS_FILENAME -- Name of the file we are loading the weights from.
+    """
+
+    return np.load(WEIGHTS_FILENAME, mmap_mode='r')
+
+
+def convert_graph(GRAPH_FILENAME, HIGHWAY_EDGES_FILENAME, ROUTING_DIRECTORY):
+    """Converts a saved graph and its highway-to-edges mapping into routing
+    data saved as a directory of NumPy arrays.
+    -----------------------------------------------------------------------
+    Keyword arguments:
+    GRAPH_FILENAME -- Name of the file of the pickled graph.
+    HIGHWAY_EDGES_FILENAME -- Name of the file of the highway-to-edges
+                              mapping.
+    ROUTING_DIRECTORY -- Name of the directory where we save the arrays.
+    """
+
+    graph = load_graph(GRAPH_FILENAME)
+    highway_edges = load_highway_edges(HIGHWAY_EDGES_FILENAME,
+                                       graph_signature(GRAPH_FILENAME))
+    if highway_edges is None:
+        raise ValueError('the highway-to-edges mapping is from another graph')
+    save_routing_data(build_routing_data(graph, highway_edges),
+                      ROUTING_DIRECTORY)
+
+
+def routing_path_coordinates(routing_data, path):
+    """Returns the list of coordinates that draws a path of the routing data,
+    following the geometry of its edges.
+    -------------------------------------------------------------------------
+    Keyword arguments:
+    routing_data -- Routing data where is represented a determined place.
+    path -- List of nodes that constitute the path.
+    """
+
+    csr = routing_data.csr
+    geometries = routing_data.geometries
+    node = csr.index[path[0]]
+    coordinates = [(float(csr.x[node]), float(csr.y[node]))]
+    for node1, node2 in zip(path, path[1:]):
+        node1 = csr.index[node1]
+        node2 = csr.index[node2]
+        start = csr.offsets[node1]
+        edge = start + int(np.flatnonzero(
+            csr.targets[start:csr.offsets[node1 + 1]] == node2)[0])
+        # the first point of the geometry is already in the list
+        start = geometries.offsets[edge] + 1
+        end = geometries.offsets[edge + 1]
+        coordinates.extend(zip(geometries.x[start:end].tolist(),
+                               geometries.y[start:end].tolist()))
+    return coordinates
+
+
+def max_speed(csr):
+    """Returns the maximum effective speed (length over itime) of the edges
+    of a compressed sparse row layout, or 0 if there is none.
+    -----------------------------------------------------------------------
+    Keyword arguments:
+    csr -- Compressed sparse row layout of the graph.
+    """
+
+    # the effective speed of an edge is its maxspeed times its congestion
+    with np.errstate(divide='ignore', invalid='ignore'):
+        speeds = csr.lengths/csr.weights
+    speeds = speeds[~np.isnan(speeds)]
+    return float(speeds.max()) if speeds.size else 0.0
+
+
+def great_circle_potentials(csr, target, speed=None):
+    """Returns a function of the index of a node that gives a lower bound of
+    its itime to a target, which is the great-circle distance divided by the
+    maximum effective speed of the graph, or None if there is no bound. It
+    is only evaluated for the nodes that a search reaches.
+    ------------------------------------------------------------------------
+    Keyword arguments:
+    csr -- Compressed sparse row layout of the graph.
+    target -- Index of the node that we want to reach.
+    speed -- Maximum effective speed of the layout. If it is not given, it
+             is computed for this search.
+    """
+
+    if speed is None:
+        speed = max_speed(csr)
+    # an edge with a null itime makes any distance reachable at once
+    if (speed == 0 or math.isinf(speed)):
+        return None
+    # same earth radius used by OSMnx to compute the length of the edges
+    EARTH_RADIUS = 6371009
+    # we leave a small margin because the lengths of the edges are rounded
+    scale = 2*EARTH_RADIUS/speed*(1 - 1e-3)
+    x = csr.x
+    y = csr.y
+    x_target = math.radians(x.item(target))
+    y_target = math.radians(y.item(target))
+    cos_target = math.cos(y_target)
+
+    def potential(node):
+        x_node = math.radians(x.item(node))
+        y_node = math.radians(y.item(node))
+        a = (math.sin((y_node - y_target)/2)**2 +
+             math.cos(y_node)*cos_target*math.sin((x_node - x_target)/2)**2)
+        return scale*math.asin(math.sqrt(min(a, 1)))
+    return potential
+
+
+def astar_shortest_path(csr, source, target, stats=None, lists=None):
+    """Returns a list of nodes that represents the shortest path between two
+    nodes using an A* search guided by the great-circle distance.
+    ------------------------------------------------------------------------
+    Keyword arguments:
+    csr -- Compressed sparse row layout of the igraph.
+    source -- Node from which we want to start the path.
+    target -- Node that we want to reach.
+    stats -- Dictionary where we want to save the number of settled nodes.
+    lists -- Lists of the layout, or None. Its maximum effective speed is
+             used instead of computing it for this search.
+    """
+
+    speed = None if lists is None else lists.speed
+    potentials = great_circle_potentials(csr, csr.index[target], speed)
+    return csr_shortest_path(csr, source, target, potentials, stats, lists)
+
+
+# an itime (meters over km/h) times ITIME_SECONDS is a time in seconds
+ITIME_SECONDS = 3.6
+# seconds into the trip from which the planned state of the congestions is
+# applied instead of the actual one
+PLANNED_HORIZON = 15*60
+
+
+def time_dependent_itime(actual, planned, time, horizon):
+    """Returns the itime of an edge entered at a given time of the trip. Up
+    to the horizon it is the actual itime, and then it moves to the planned
+    one. If the planned itime is smaller, it decreases as fast as time goes
+    by, so entering an edge later never gets to its end earlier (FIFO), and
+    the planned state only takes full effect actual - planned past the
+    horizon. An edge cut now (infinite actual itime) is left at the horizon
+    plus its planned itime, as if it was waited for to reopen.
+    -----------------------------------------------------------------------
+    Keyword arguments:
+    actual -- Itime of the edge with the actual state.
+    planned -- Itime of the edge with the planned state.
+    time -- Itime from the start of the trip when the edge is entered.
+    horizon -- Itime from the start of the trip from which the planned state
+               is applied.
+    """
+
+    if math.isinf(actual):
+        return max(time, horizon) + planned - time
+    if (time <= horizon):
+        return actual
+    return max(planned, actual - (time - horizon))
+
+
+def time_dependent_shortest_path(csr, planned, source, target,
+                                 horizon=PLANNED_HORIZON, potentials=None,
+                                 stats=None, lists=None):
+    """Returns a list of nodes that represents the fastest path between two
+    nodes when the edges reached after the horizon have the planned itime
+    (see time_dependent_itime), or None if there is no path. The weights of
+    the compressed layout are the actual itimes.
+    -----------------------------------------------------------------------
+    Keyword arguments:
+    csr -- Compressed sparse row layout of the graph.
+    planned -- Array with the planned itime of every edge, aligned with the
+               weights of the compressed layout.
+    source -- Node from which we want to start the path.
+    target -- Node that we want to reach.
+    horizon -- Seconds into the trip from which the planned state is
+               applied.
+    potentials -- Lower bound of the itime from every node to the target,
+                  as an array or a function of the index of a node. If they
+                  are given, an A* search is done.
+    stats -- Dictionary where we want to save the number of settled nodes
+             and the itime of the path.
+    lists -- Lists of the layout and of the planned itimes. If they are not
+             given, they are built for this search.
+    """
+
+    source = csr.index[source]
+    target = csr.index[target]
+    horizon = horizon/ITIME_SECONDS
+    if lists is None or lists.planned is None:
+        lists = csr_lists(csr, planned)
+    offsets, targets = lists.offsets, lists.targets
+    actuals, planneds = lists.weights, lists.planned
+    infinity = float('inf')
+    # the lower bounds are only computed for the nodes reached
+    potential = potential_function(potentials)
+    estimates = {}
+
+    # as the itimes are FIFO, the earliest arrival to every node is the one
+    # worth extending, just like in a Dijkstra search
+    arrivals = {source: 0.0}
+    previous = {}
+    settled = set()
+    heap = [(0.0, source)]
+    while heap:
+        key, node1 = heapq.heappop(heap)
+        if node1 in settled:
+            continue
+        settled.add(node1)
+        if (node1 == target):
+            break
+        arrival = arrivals[node1]
+        for position in range(offsets[node1], offsets[node1 + 1]):
+            node2 = targets[position]
+            actual = actuals[position]
+            # the streets cut now are left when they are planned to reopen
+            if (actual == infinity):
+                itime = max(arrival, horizon) + planneds[position] - arrival
+            elif (arrival <= horizon):
+                itime = actual
+            else:
+                itime = max(planneds[position], actual - (arrival - horizon))
+            new_arrival = arrival + itime
+            if (node2 not in arrivals or new_arrival < arrivals[node2]):
+                arrivals[node2] = new_arrival
+                previous[node2] = node1
+                key = new_arrival
+                if potential is not None:
+                    estimate = estimates.get(node2)
+                    if estimate is None:
+                        estimate = estimates[node2] = potential(node2)
+                    key += estimate
+                heapq.heappush(heap, (key, node2))
+
+    if stats is not None:
+        stats['settled'] = len(settled)
+        stats['itime'] = arrivals.get(target, float('inf'))
+    if target not in settled:
+        return None
+    path = [target]
+    while path[-1] != source:
+        path.append(previous[path[-1]])
+    return [csr.nodes[node].item() for node in reversed(path)]
+
+
+def time_dependent_path_itime(csr, planned, path, horizon=PLANNED_HORIZON):
+    """Returns the itime of a path when the edges reached after the horizon
+    have the planned itime.
+    -----------------------------------------------------------------------
+    Keyword arguments:
+    csr -- Compressed sparse row layout of the graph.
+    planned -- Array with the planned itime of every edge.
+    path -- List of nodes that constitute the path.
+    horizon -- Seconds into the trip from which the planned state is
+               applied.
+    """
+
+    horizon = horizon/ITIME_SECONDS
+    arrival = 0.0
+    for position in path_positions(csr, path).tolist():
+        arrival += time_dependent_itime(float(csr.weights[position]),
+                                        float(planned[position]), arrival,
+                                        horizon)
+    return arrival
+
+
+def path_positions(csr, path):
+    """Returns an array with the position of every edge of a path in the
+    compressed sparse row layout.
+    --------------------------------------------------------------------
+    Keyword arguments:
+    csr -- Compressed sparse row layout of the graph.
+    path -- List of nodes that constitute the path.
+    """
+
+    positions = []
+    for node1, node2 in zip(path, path[1:]):
+        index1 = csr.index[node1]
+        start, end = csr.offsets[index1], csr.offsets[index1 + 1]
+        positions.append(start + int(np.flatnonzero(
+            csr.targets[start:end] == csr.index[node2])[0]))
+    return np.array(positions, dtype=np.int64)
+
+
+def build_route(csr, path, planned=None, horizon=PLANNED_HORIZON):
+    """Returns the route of a path, with its itime and length.
+    ----------------------------------------------------------
+    Keyword arguments:
+    csr -- Compressed sparse row layout of the graph.
+    path -- List of nodes that constitute the path.
+    planned -- Array with the planned itime of every edge, if the path was
+               found with them.
+    horizon -- Seconds into the trip from which the planned state is
+               applied.
+    """
+
+    positions = path_positions(csr, path)
+    if planned is not None:
+        itime = time_dependent_path_itime(csr, planned, path, horizon)
+    else:
+        itime = float(csr.weights[positions].sum())
+    return Route(path, positions, itime, float(csr.lengths[positions].sum()),
+                 None)
+
+
+def open_route_cache(size=1024):
+    """Returns a route cache, which keeps in memory the most recently used
+    routes.
+    ----------------------------------------------------------------------
+    Keyword arguments:
+    size -- Maximum number of routes kept.
+    """
+
+    return RouteCache(collections.OrderedDict(), threading.Lock(), size,
+                      collections.Counter())
+
+
+def get_route(route_cache, version, source, target):
+    """Returns the route between two nodes with a version of the weights
+    from the route cache, or None if it is not cached.
+    --------------------------------------------------------------------
+    Keyword arguments:
+    route_cache -- Route cache where the route is looked up.
+    version -- Version of the weights of the route.
+    source -- Node from which the route starts.
+    target -- Node that the route reaches.
+    """
+
+    key = (version, source, target)
+    with route_cache.lock:
+        route = route_cache.memory.get(key)
+        if route is None:
+            route_cache.stats['misses'] += 1
+            return None
+        route_cache.memory.move_to_end(key)
+        route_cache.stats['hits'] += 1
+        return route
+
+
+def cache_route(route_cache, version, source, target, route):
+    """Saves the route between two nodes with a version of the weights in the
+    route cache.
+    -------------------------------------------------------------------------
+    Keyword arguments:
+    route_cache -- Route cache where we want to save the route.
+    version -- Version of the weights of the route.
+    source -- Node from which the route starts.
+    target -- Node that the route reaches.
+    route -- Route we want to save.
+    """
+
+    key = (version, source, target)
+    with route_cache.lock:
+        memory = route_cache.memory
+        memory[key] = route
+        memory.move_to_end(key)
+        while len(memory) > route_cache.size:
+            memory.popitem(last=False)
+            route_cache.stats['evictions'] += 1
+
+
+def invalidate_routes(route_cache, old_version, new_version, old_weights,
+                      new_weights):
+    """Moves the cached routes to a new version of the weights, dropping the
+    ones that may have changed. If any weight has decreased, a better route
+    may exist for every pair, so every route is dropped. Otherwise only the
+    routes that cross an edge whose weight has increased are dropped.
+    ------------------------------------------------------------------------
+    Keyword arguments:
+    route_cache -- Route cache we want to update.
+    old_version -- Version of the weights of the cached routes.
+    new_version -- New version of the weights.
+    old_weights -- List of the arrays of weights of the old version (the
+                   actual and the planned itimes, or None if they are not
+                   used).
+    new_weights -- List of the arrays of weights of the new version.
+    """
+
+    increased = np.zeros(len(new_weights[0]), dtype=bool)
+    decreased = False
+    for old, new in zip(old_weights, new_weights):
+        if old is None or new is None:
+            continue
+        increased |= np.asarray(new) > np.asarray(old)
+        decreased |= bool((np.asarray(new) < np.asarray(old)).any())
+    with route_cache.lock:
+        memory = route_cache.memory
+        routes = list(memory.items())
+        memory.clear()
+        if decreased:
+            route_cache.stats['cleared'] += 1
+            route_cache.stats['invalidated'] += len(routes)
+            return
+        # the routes keep their order of use
+        for (version, source, target), route in routes:
+            if (version == old_version and
+                    not increased[route.positions].any()):
+                memory[(new_version, source, target)] = route
+            else:
+                route_cache.stats['invalidated'] += 1
+
+
+def open_geocode_cache(GEOCODE_FILENAME=None, ttl=30*24*3600, size=1024,
+                       disk_size=100000):
+    """Returns a geocode cache, stored in a SQLite database if a file is
+    given and only in memory otherwise.
+    --------------------------------------------------------------------
+    Keyword arguments:
+    GEOCODE_FILENAME -- Name of the SQLite database of the cache.
+    ttl -- Seconds after which a geocoded location has to be geocoded again.
+    size -- Maximum number of locations kept in memory.
+    disk_size -- Maximum number of locations kept in the database.
+    """
+
+    connection = None
+    if GEOCODE_FILENAME is not None:
+        # the bot answers every request in its own thread, and every worker
+        # process has its own connection, so the readers never wait for the
+        # writer (WAL) and a writer waits for another one
+        connection = sqlite3.connect(GEOCODE_FILENAME, timeout=30,
+                                     check_same_thread=False)
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute('CREATE TABLE IF NOT EXISTS geocodes '
+                           '(query TEXT PRIMARY KEY, latitude REAL, '
+                           'longitude REAL, expires REAL)')
+        connection.commit()
+    return GeocodeCache(collections.OrderedDict(), connection,
+                        threading.Lock(), ttl, size, disk_size,
+                        collections.Counter())
+
+
+def normalize_location(location):
+    """Returns the key used by the geocode cache for a certain location.
+    --------------------------------------------------------------------
+    Keyword arguments:
+    location -- Name of the location.
+    """
+
+    return ' '.join(location.lower().split())
+
+
+def remember_geocode(geocode_cache, query, coordinates, expires):
+    """Keeps the coordinates of a location in the memory of the geocode
+    cache.
+    -------------------------------------------------------------------
+    Keyword arguments:
+    geocode_cache -- Geocode cache where we want to keep the location.
+    query -- Normalized name of the location.
+    coordinates -- Latitude and longitude of the location.
+    expires -- Timestamp when the location expires, or None if it never
+               expires.
+    """
+
+    memory = geocode_cache.memory
+    memory[query] = (coordinates, expires)
+    memory.move_to_end(query)
+    while len(memory) > geocode_cache.size:
+        memory.popitem(last=False)
+
+
+def evict_geocodes(geocode_cache):
+    """Removes from the database of the geocode cache the locations over its
+    maximum size, the ones that expire first. It does not commit.
+    ------------------------------------------------------------------------
+    Keyword arguments:
+    geocode_cache -- Geocode cache whose database we want to trim.
+    """
+
+    connection = geocode_cache.connection
+    rows = connection.execute('SELECT COUNT(*) FROM geocodes').fetchone()[0]
+    if (rows > geocode_cache.disk_size):
+        connection.execute('DELETE FROM geocodes WHERE query IN '
+                           '(SELECT query FROM geocodes ORDER BY expires IS '
+                           'NOT NULL, expires DESC LIMIT -1 OFFSET ?)',
+                           (geocode_cache.disk_size,))
+
+
+def cache_geocode(geocode_cache, query, coordinates, expires):
+    """Saves the coordinates of a location in the geocode cache.
+    ------------------------------------------------------------
+    Keyword arguments:
+    geocode_cache -- Geocode cache where we want to save the location.
+    query -- Normalized name of the location.
+    coordinates -- Latitude and longitude of the location.
+    expires -- Timestamp when the location expires, or None if it never
+               expires.
+    """
+
+    remember_geocode(geocode_cache, query, coordinates, expires)
+    connection = geocode_cache.connection
+    if connection is not None:
+        with connection:
+            connection.execute('INSERT OR REPLACE INTO geocodes VALUES '
+                               '(?, ?, ?, ?)', (query, *coordinates, expires))
+            evict_geocodes(geocode_cache)
+
+
+def geocode(location, geocode_cache=None):
+    """Returns the latitude and longitude of a location of Barcelona.
+    -----------------------------------------------------------------
+    Keyword arguments:
+    location -- Name of the location, or its latitude and longitude.
+    geocode_cache -- Geocode cache where the location is looked up before
+                     asking Nominatim.
+    """
+
+    # locations that are already coordinates are not geocoded
+    if not isinstance(location, str):
+        return tuple(location)
+    complete_location = location + ", Barcelona, Catalunya"
+    if geocode_cache is None:
+        return ox.geocode(complete_location)
+
+    query = normalize_location(location)
+    now = time.time()
+    with geocode_cache.lock:
+        entry = geocode_cache.memory.get(query)
+        if entry is not None and (entry[1] is None or entry[1] > now):
+            geocode_cache.memory.move_to_end(query)
+            geocode_cache.stats['memory_hits'] += 1
+            return entry[0]
+        if geocode_cache.connection is not None:
+            row = geocode_cache.connection.execute(
+                'SELECT latitude, longitude, expires FROM geocodes '
+                'WHERE query = ?', (query,)).fetchone()
+            if row is not None and (row[2] is None or row[2] > now):
+                # the row is already on disk, so it is not written again
+                remember_geocode(geocode_cache, query, row[:2], row[2])
+                geocode_cache.stats['disk_hits'] += 1
+                return row[:2]
+        geocode_cache.stats['misses'] += 1
+
+    coordinates = tuple(ox.geocode(complete_location))
+    with geocode_cache.lock:
+        cache_geocode(geocode_cache, query, coordinates,
+                      now + geocode_cache.ttl)
+    return coordinates
+
+
+def parse_seed_location(line):
+    """Returns the (query, latitude, longitude, expires) row of the geocode
+    cache of a line of a seed file, without expiration, or None if the line
+    is malformed (such as a header).
+    -----------------------------------------------------------------------
+    Keyword arguments:
+    line -- List of fields (location, latitude, longitude) of the line.
+    """
+
+    if (len(line) != 3):
+        return None
+    location, latitude, longitude = line
+    try:
+        latitude = float(latitude)
+        longitude = float(longitude)
+    except ValueError:
+        return None
+    if not (-90 <= latitude <= 90 and -180 <= longitude <= 180):
+        return None
+    return (normalize_location(location), latitude, longitude, None)
+
+
+def seed_geocode_cache(geocode_cache, SEED_FILENAME, stats=None):
+    """Saves in the geocode cache, without expiration, the locations of a CSV
+    file with a name, latitude and longitude on every line, skipping the
+    malformed lines.
+    -------------------------------------------------------------------------
+    Keyword arguments:
+    geocode_cache -- Geocode cache we want to seed.
+    SEED_FILENAME -- Name of the CSV file with the locations.
+    stats -- Dictionary where we want to count the lines read and skipped.
+    """
+
+    with open(SEED_FILENAME, newline='', encoding='utf-8') as file:
+        reader = csv.reader(file, delimiter=',', quotechar='"')
+        rows = []
+        for line in reader:
+            row = parse_seed_location(line)
+            count_row(stats, row is not None)
+            if row is not None:
+                rows.append(row)
+    with geocode_cache.lock:
+        for query, latitude, longitude, expires in rows:
+            remember_geocode(geocode_cache, query, (latitude, longitude),
+                             expires)
+        # all the locations are saved in a single transaction
+        connection = geocode_cache.connection
+        if connection is not None:
+            with connection:
+                connection.executemany('INSERT OR REPLACE INTO geocodes '
+                                       'VALUES (?, ?, ?, ?)', rows)
+                evict_geocodes(geocode_cache)
+
+
+def open_session_store(SESSIONS_FILENAME=None, ttl=24*3600, nodes=None):
+    """Returns a session store, loading the sessions saved in a file if it is
+    given and exists.
+    -------------------------------------------------------------------------
+    Keyword arguments:
+    SESSIONS_FILENAME -- Name of the file where the sessions are saved.
+    ttl -- Seconds a position is kept since it is saved.
+    nodes -- Nodes of the current graph (as a container), or None. The saved
+             nodes that are not among them are forgotten, so they are found
+             again from the positions.
+    """
+
+    memory = collections.OrderedDict()
+    if SESSIONS_FILENAME is not None and os.path.exists(SESSIONS_FILENAME):
+        with open(SESSIONS_FILENAME, 'rb') as file:
+            memory.update(pickle.load(file))
+    # the graph may have been rebuilt since the sessions were saved
+    if nodes is not None:
+        for chat_id, session in memory.items():
+            if session.node is not None and session.node not in nodes:
+                memory[chat_id] = session._replace(node=None)
+    session_store = SessionStore(memory, threading.Lock(), ttl,
+                                 SESSIONS_FILENAME)
+    with session_store.lock:
+        evict_sessions(session_store)
+    return session_store
+
+
+def evict_sessions(session_store):
+    """Removes the expired sessions of a session store. As the sessions are
+    kept in the order they expire, only the expired ones are visited.
+    -----------------------------------------------------------------------
+    Keyword arguments:
+    session_store -- Session store we want to clean.
+    """
+
+    memory = session_store.memory
+    now = time.time()
+    while memory and next(iter(memory.values())).expires <= now:
+        memory.popitem(last=False)
+
+
+def get_session(session_store, chat_id):
+    """Returns the session of a user, or None if it has no position or it has
+    expired.
+    -------------------------------------------------------------------------
+    Keyword arguments:
+    session_store -- Session store where the session is looked up.
+    chat_id -- Chat ID of the user.
+    """
+
+    with session_store.lock:
+        evict_sessions(session_store)
+        return session_store.memory.get(chat_id)
+
+
+def save_session(session_store, chat_id, position, node=None):
+    """Saves the position of a user, and its nearest node if it is known.
+    ---------------------------------------------------------------------
+    Keyword arguments:
+    session_store -- Session store where we want to save the session.
+    chat_id -- Chat ID of the user.
+    position -- Name of the location, or coordinates, of the user.
+    node -- Nearest node of the position, or None if it is not found yet.
+    """
+
+    with session_store.lock:
+        memory = session_store.memory
+        memory[chat_id] = Session(position, node,
+                                  time.time() + session_store.ttl)
+        memory.move_to_end(chat_id)
+        evict_sessions(session_store)
+
+
+def set_session_node(session_store, chat_id, position, node):
+    """Saves the nearest node of the position of a user, unless the user has
+    moved meanwhile.
+    ------------------------------------------------------------------------
+    Keyword arguments:
+    session_store -- Session store where the session is saved.
+    chat_id -- Chat ID of the user.
+    position -- Position whose nearest node was found.
+    node -- Nearest node of the position.
+    """
+
+    with session_store.lock:
+        session = session_store.memory.get(chat_id)
+        if session is not None and session.position == position:
+            session_store.memory[chat_id] = session._replace(node=node)
+
+
+def save_session_store(session_store):
+    """Saves the sessions of a session store in its file, so they are kept
+    when the bot restarts. The file is written aside and renamed, so it is
+    never read half-written. A store only kept in memory is not saved.
+    ----------------------------------------------------------------------
+    Keyword arguments:
+    session_store -- Session store we want to save.
+    """
+
+    if session_store.filename is None:
+        return
+    with session_store.lock:
+        evict_sessions(session_store)
+        sessions = list(session_store.memory.items())
+    with open(session_store.filename + '.tmp', 'wb') as file:
+        pickle.dump(sessions, file)
+    os.replace(session_store.filename + '.tmp', session_store.filename)
+
+
+def get_node(graph, location, spatial_index=None, geocode_cache=None):
     """Returns the nearest node in the given graph from a certain location.
     ----------------------------------------------------------------------
     Keyword arguments:
     graph -- Graph where we want to find the node.
     location -- Name of the location from which we are looking for
-                the nearest node.
+                the nearest node, its coordinates or the node itself.
+    spatial_index -- Spatial index of the graph. If it is given, it is used
+                     to find the nearest node.
+    geocode_cache -- Geocode cache where the location is looked up.
     """
 
-    complete_location = location + ", Barcelona, Catalunya"
-    coordinates = ox.geocode(complete_location)
+    # nodes are already found
+    if isinstance(location, (int, np.integer)):
+        return location
+    coordinates = geocode(location, geocode_cache)
+    if spatial_index is not None:
+        return nearest_nodes(spatial_index, coordinates[1], coordinates[0])
     node = ox.nearest_nodes(graph, coordinates[1], coordinates[0])
     return node
 
 
-def get_shortest_path_with_ispeeds(graph, source, target):
+def get_shortest_path_with_ispeeds(graph, source, target, csr=None,
+                                   landmarks=None, astar=False, stats=None,
+                                   spatial_index=None, geocode_cache=None,
+                                   planned=None, horizon=PLANNED_HORIZON,
+                                   lists=None):
     """Returns a list of nodes that represents the shortest path between two
     locations, applying the itime attribute.
     -----------------------------------------------------------------------
@@ -306,45 +2382,479 @@ def get_shortest_path_with_ispeeds(graph, source, target):
     graph -- Graph where is represented a determined place.
     source -- Location from which we want to start the path.
     target -- Location that we want to reach.
+    csr -- Compressed sparse row layout of the graph with the itimes as
+           weights. If it is given, the path is found over it.
+    landmarks -- Landmarks of the graph. If they are given together with the
+                 compressed layout, the path is found with an ALT search.
+    astar -- If it is True, the path is found over the compressed layout with
+             an A* search guided by the great-circle distance.
+    stats -- Dictionary where we want to save the number of settled nodes
+             when the compressed layout is used.
+    spatial_index -- Spatial index of the graph used to find the nodes of the
+                     locations.
+    geocode_cache -- Geocode cache where the locations are looked up.
+    planned -- Array with the planned itime of every edge. If it is given
+               together with the compressed layout, the edges reached after
+               the horizon have the planned itime.
+    horizon -- Seconds into the trip from which the planned state is
+               applied.
+    lists -- Lists of the compressed layout (and of the planned itimes),
+             built once for its version of the weights.
     """
 
-    source_node = get_node(graph, source)
-    target_node = get_node(graph, target)
+    source_node = get_node(graph, source, spatial_index, geocode_cache)
+    target_node = get_node(graph, target, spatial_index, geocode_cache)
+    if csr is not None and planned is not None:
+        # the landmarks are lower bounds of any congestion, so they also
+        # guide the time-dependent search
+        potentials = None
+        if landmarks is not None:
+            potentials = landmark_potentials(landmarks,
+                                             csr.index[target_node])
+        return time_dependent_shortest_path(csr, planned, source_node,
+                                            target_node, horizon, potentials,
+                                            stats, lists)
+    if csr is not None and landmarks is not None:
+        return alt_shortest_path(csr, landmarks, source_node, target_node,
+                                 stats, lists)
+    if csr is not None and astar:
+        return astar_shortest_path(csr, source_node, target_node, stats,
+                                   lists)
+    if csr is not None:
+        return csr_shortest_path(csr, source_node, target_node, stats=stats,
+                                 lists=lists)
     path = ox.shortest_path(graph, source_node, target_node, 'itime')
     return path
 
 
-def plot_path(graph, path, SIZE):
+def get_nodes(graph, locations, spatial_index=None, geocode_cache=None):
+    """Returns the nearest node in the given graph from every location of a
+    list. The nodes are found at once with the spatial index.
+    ------------------------------------------------------------------------
+    Keyword arguments:
+    graph -- Graph, or routing data, where we want to find the nodes.
+    locations -- List of nodes, names of locations or (latitude, longitude)
+                 coordinates.
+    spatial_index -- Spatial index of the graph. If it is not given, it is
+                     built from the graph.
+    geocode_cache -- Geocode cache where the locations are looked up.
+    """
+
+    nodes = list(locations)
+    positions = [i for i, location in enumerate(locations)
+                 if not isinstance(location, (int, np.integer))]
+    if positions:
+        if spatial_index is None:
+            spatial_index = build_spatial_index(graph)
+        coordinates = np.array([geocode(locations[i], geocode_cache)
+                                for i in positions], dtype=float)
+        found = nearest_nodes(spatial_index, coordinates[:, 1],
+                              coordinates[:, 0])
+        for i, node in zip(positions, found):
+            nodes[i] = node
+    return nodes
+
+
+def route_matrix(graph, sources, targets, csr, processes=None,
+                 spatial_index=None, geocode_cache=None):
+    """Returns two arrays with the itime and the length of the shortest path
+    from every source to every target (infinite if there is no path). The
+    itimes times ITIME_SECONDS are the estimated times of arrival in seconds.
+    -------------------------------------------------------------------------
+    Keyword arguments:
+    graph -- Graph, or routing data, where is represented a determined place.
+    sources -- List of nodes, names of locations or (latitude, longitude)
+               coordinates from which we want the paths.
+    targets -- List of nodes, names of locations or (latitude, longitude)
+               coordinates that we want to reach.
+    csr -- Compressed sparse row layout of the graph with the itimes as
+           weights.
+    processes -- Number of processes among which the searches are shared.
+                 If it is None, they are done in this process.
+    spatial_index -- Spatial index of the graph used to find the nodes of the
+                     locations.
+    geocode_cache -- Geocode cache where the locations are looked up.
+    """
+
+    source_nodes = get_nodes(graph, sources, spatial_index, geocode_cache)
+    target_nodes = get_nodes(graph, targets, spatial_index, geocode_cache)
+    return csr_matrix(csr, source_nodes, target_nodes, processes)
+
+
+def path_coordinates(graph, path):
+    """Returns the list of coordinates that draws a path, following the
+    geometry of its edges.
+    -------------------------------------------------------------------
+    Keyword arguments:
+    graph -- Directed graph, or routing data, where is represented a
+             determined place.
+    path -- List of nodes that constitute the path.
+    """
+
+    if isinstance(graph, RoutingData):
+        return routing_path_coordinates(graph, path)
+    node = graph.nodes[path[0]]
+    coordinates = [(node['x'], node['y'])]
+    for node1, node2 in zip(path, path[1:]):
+        edge = graph[node1][node2]
+        if 'geometry' in edge:
+            # the first point of the geometry is already in the list
+            coordinates.extend(edge['geometry'].coords[1:])
+        else:
+            node = graph.nodes[node2]
+            coordinates.append((node['x'], node['y']))
+    return coordinates
+
+
+def longitude_to_x(longitude, zoom):
+    """Returns the web mercator tile coordinate x of a longitude.
+    -------------------------------------------------------------
+    Keyword arguments:
+    longitude -- Longitude, or array of longitudes, we want to project.
+    zoom -- Zoom level of the tiles.
+    """
+
+    return (np.asarray(longitude) + 180)/360*2**zoom
+
+
+def latitude_to_y(latitude, zoom):
+    """Returns the web mercator tile coordinate y of a latitude.
+    ------------------------------------------------------------
+    Keyword arguments:
+    latitude -- Latitude, or array of latitudes, we want to project.
+    zoom -- Zoom level of the tiles.
+    """
+
+    latitude = np.radians(latitude)
+    return (1 - np.log(np.tan(latitude) + 1/np.cos(latitude))/math.pi)/2 * \
+        2**zoom
+
+
+def basemap_pixels(basemap, coordinates):
+    """Returns the pixels of a basemap where a list of coordinates lie.
+    -------------------------------------------------------------------
+    Keyword arguments:
+    basemap -- Basemap where we want to draw.
+    coordinates -- List of (longitude, latitude) coordinates.
+    """
+
+    TILE_SIZE = 256
+    longitudes, latitudes = np.array(coordinates, dtype=float).reshape(-1, 2).T
+    width, height = basemap.image.size
+    x = (longitude_to_x(longitudes, basemap.zoom) - basemap.x_center) * \
+        TILE_SIZE + width/2
+    y = (latitude_to_y(latitudes, basemap.zoom) - basemap.y_center) * \
+        TILE_SIZE + height/2
+    return list(zip(x.round().tolist(), y.round().tolist()))
+
+
+def fit_basemap(west, south, east, north, SIZE):
+    """Returns the zoom and center of the greatest map of a given size where a
+    bounding box fits.
+    -------------------------------------------------------------------------
+    Keyword arguments:
+    west, south, east, north -- Bounding box we want to fit in the map.
+    SIZE -- Size of the map.
+    """
+
+    TILE_SIZE = 256
+    zoom = 0
+    for level in range(18, -1, -1):
+        width = (longitude_to_x(east, level) - longitude_to_x(west, level))
+        height = (latitude_to_y(south, level) - latitude_to_y(north, level))
+        if (max(width, height)*TILE_SIZE <= SIZE):
+            zoom = level
+            break
+    x_center = float(longitude_to_x((west + east)/2, zoom))
+    y_center = float((latitude_to_y(south, zoom) +
+                      latitude_to_y(north, zoom))/2)
+    return zoom, x_center, y_center
+
+
+def graph_bounds(graph):
+    """Returns the west, south, east and north bounds of the nodes of a graph.
+    --------------------------------------------------------------------------
+    Keyword arguments:
+    graph -- Graph, or routing data, we want the bounds from.
+    """
+
+    nodes, longitudes, latitudes = node_coordinates(graph)
+    return (float(longitudes.min()), float(latitudes.min()),
+            float(longitudes.max()), float(latitudes.max()))
+
+
+def render_basemap(graph, SIZE, colour='lightgray'):
+    """Returns an offline basemap of a given size with every street of a graph
+    drawn on it, which can be reused as background of the plotted maps.
+    -------------------------------------------------------------------------
+    Keyword arguments:
+    graph -- Directed graph, or routing data, with the streets we want to
+             draw.
+    SIZE -- Size of the basemap.
+    colour -- Colour of the streets.
+    """
+
+    zoom, x_center, y_center = fit_basemap(*graph_bounds(graph), SIZE)
+    basemap = Basemap(Image.new('RGB', (SIZE, SIZE), 'white'), zoom,
+                      x_center, y_center)
+    draw = ImageDraw.Draw(basemap.image)
+    if isinstance(graph, RoutingData):
+        geometries = graph.geometries
+        streets = (np.column_stack([geometries.x[start:end],
+                                    geometries.y[start:end]])
+                   for start, end in zip(geometries.offsets[:-1],
+                                         geometries.offsets[1:]))
+    else:
+        streets = (path_coordinates(graph, [node1, node2])
+                   for node1, node2 in graph.edges())
+    for coordinates in streets:
+        draw.line(basemap_pixels(basemap, coordinates), fill=colour, width=1)
+    return basemap
+
+
+def draw_line(image, pixels, colour, width):
+    """Draws a line with rounded joints in an image.
+    ------------------------------------------------
+    Keyword arguments:
+    image -- Image where we want to draw.
+    pixels -- List of pixels of the line.
+    colour -- Colour of the line.
+    width -- Width of the line.
+    """
+
+    ImageDraw.Draw(image).line(pixels, fill=colour, width=width,
+                               joint='curve')
+
+
+def draw_marker(image, pixel, colour, radius):
+    """Draws a circle marker in an image.
+    -------------------------------------
+    Keyword arguments:
+    image -- Image where we want to draw.
+    pixel -- Pixel of the center of the marker.
+    colour -- Colour of the marker.
+    radius -- Radius of the marker.
+    """
+
+    x, y = pixel
+    ImageDraw.Draw(image).ellipse((x - radius, y - radius, x + radius,
+                                   y + radius), fill=colour)
+
+
+def open_tile_cache(TILES_DIRECTORY=None, size=256, downloads=4):
+    """Returns a map tile cache, stored in a directory if it is given and only
+    in memory otherwise. The tiles kept in memory belong to the process, but
+    the directory can be shared by several processes.
+    -------------------------------------------------------------------------
+    Keyword arguments:
+    TILES_DIRECTORY -- Name of the directory where the tiles are stored.
+    size -- Maximum number of tiles kept in memory.
+    downloads -- Maximum number of tiles downloaded at the same time by all
+                 the maps of the process, or a semaphore that bounds them,
+                 such as a multiprocessing one shared by several processes.
+    """
+
+    if TILES_DIRECTORY is not None:
+        os.makedirs(TILES_DIRECTORY, exist_ok=True)
+    if isinstance(downloads, int):
+        downloads = threading.BoundedSemaphore(downloads)
+    return TileCache(TILES_DIRECTORY, collections.OrderedDict(),
+                     threading.Lock(), size, downloads,
+                     collections.Counter())
+
+
+def get_tile(tile_cache, url, **kwargs):
+    """Returns the status code and the content of a map tile, looking it up in
+    the tile cache before downloading it.
+    -------------------------------------------------------------------------
+    Keyword arguments:
+    tile_cache -- Tile cache where the tile is looked up.
+    url -- URL of the tile.
+    kwargs -- Arguments of the request if the tile has to be downloaded.
+    """
+
+    with tile_cache.lock:
+        content = tile_cache.memory.get(url)
+        if content is not None:
+            tile_cache.memory.move_to_end(url)
+            tile_cache.stats['memory_hits'] += 1
+            return 200, content
+
+    filename = None
+    if tile_cache.directory is not None:
+        filename = os.path.join(tile_cache.directory,
+                                hashlib.sha1(url.encode()).hexdigest())
+        if os.path.exists(filename):
+            with open(filename, 'rb') as file:
+                content = file.read()
+            tile_cache.stats['disk_hits'] += 1
+
+    if content is None:
+        with tile_cache.downloads:
+            response = requests.get(url, **kwargs)
+        tile_cache.stats['misses'] += 1
+        if (response.status_code != 200):
+            return response.status_code, response.content
+        content = response.content
+        if filename is not None:
+            # the tile is renamed once written, so it is never read halfway
+            with open(filename + '.part', 'wb') as file:
+                file.write(content)
+            os.replace(filename + '.part', filename)
+
+    with tile_cache.lock:
+        tile_cache.memory[url] = content
+        while len(tile_cache.memory) > tile_cache.size:
+            tile_cache.memory.popitem(last=False)
+    return 200, content
+
+
+class CachedStaticMap(StaticMap):
+    """Static map that takes its map tiles from a tile cache.
+    """
+
+    def __init__(self, width, height, tile_cache, **kwargs):
+        super().__init__(width, height, **kwargs)
+        self.tile_cache = tile_cache
+
+    def get(self, url, **kwargs):
+        return get_tile(self.tile_cache, url, **kwargs)
+
+
+def new_map(SIZE, tile_cache=None):
+    """Returns an empty static map of a given size.
+    -----------------------------------------------
+    Keyword arguments:
+    SIZE -- Size of the map.
+    tile_cache -- Tile cache where the map tiles are looked up.
+    """
+
+    if tile_cache is None:
+        return StaticMap(SIZE, SIZE)
+    return CachedStaticMap(SIZE, SIZE, tile_cache)
+
+
+def render_tile_basemap(graph, SIZE, tile_cache=None):
+    """Returns a basemap of a given size with the map tiles of the whole place
+    of a graph, which can be reused as background of the plotted maps.
+    -------------------------------------------------------------------------
+    Keyword arguments:
+    graph -- Graph of the place we want to draw.
+    SIZE -- Size of the basemap.
+    tile_cache -- Tile cache where the map tiles are looked up.
+    """
+
+    west, south, east, north = graph_bounds(graph)
+    zoom, x_center, y_center = fit_basemap(west, south, east, north, SIZE)
+    map = new_map(SIZE, tile_cache)
+    image = map.render(zoom, [(west + east)/2, (south + north)/2])
+    return Basemap(image, zoom, map.x_center, map.y_center)
+
+
+def render_map(SIZE, lines, markers, basemap=None, tile_cache=None):
+    """Returns the image of a map with some lines and circle markers.
+    -----------------------------------------------------------------
+    Keyword arguments:
+    SIZE -- Size of the map.
+    lines -- List of (coordinates, colour, width) lines.
+    markers -- List of (coordinate, colour, radius) markers.
+    basemap -- Basemap used as background. If it is not given, the map tiles
+               are fetched for this map.
+    tile_cache -- Tile cache where the map tiles are looked up.
+    """
+
+    if basemap is not None:
+        # we only draw the lines and markers over a copy of the basemap
+        image = basemap.image.copy()
+        for coordinates, colour, width in lines:
+            draw_line(image, basemap_pixels(basemap, coordinates), colour,
+                      width)
+        for coordinate, colour, radius in markers:
+            draw_marker(image, basemap_pixels(basemap, [coordinate])[0],
+                        colour, radius)
+        return image
+
+    map = new_map(SIZE, tile_cache)
+    for coordinates, colour, width in lines:
+        map.add_line(Line(coordinates, colour, width))
+    for coordinate, colour, radius in markers:
+        map.add_marker(CircleMarker(coordinate, colour, radius))
+    return map.render()
+
+
+def encode_image(image, output=None, format='PNG', options=None):
+    """Encodes an image and writes it in a file or buffer. If no output is
+    given, the encoded bytes are returned.
+    ----------------------------------------------------------------------
+    Keyword arguments:
+    image -- Image we want to encode.
+    output -- File, or buffer, where we want to write the image.
+    format -- Format of the image (PNG, JPEG or WEBP).
+    options -- Dictionary with the encoding options of the format, such as
+               compress_level for PNG or quality for JPEG and WEBP.
+    """
+
+    options = options or {}
+    if (format.upper() == 'JPEG'):
+        # JPEG does not support transparency
+        image = image.convert('RGB')
+    if output is not None:
+        image.save(output, format, **options)
+        return None
+    buffer = io.BytesIO()
+    image.save(buffer, format, **options)
+    return buffer.getvalue()
+
+
+def plot_path(graph, path, SIZE, basemap=None, tile_cache=None, output=None,
+              format='PNG', options=None):
     """Plots the shortest path, previously found, between two locations and
-    saves the result as a png file.
+    returns the encoded image, unless it is written in a given output.
     -----------------------------------------------------------------------
     Keyword arguments:
     graph -- Graph where is represented a determined place.
     path -- List of nodes that constitute the shortest path between
             two locations.
     SIZE -- Size of the map where we want to plot the path to.
+    basemap -- Basemap used as background instead of the map tiles.
+    tile_cache -- Tile cache where the map tiles are looked up.
+    output -- File, or buffer, where we want to write the image.
+    format -- Format of the image (PNG, JPEG or WEBP).
+    options -- Dictionary with the encoding options of the format.
     """
 
     # plots the path
-    coordinates = []
-    for point in path:
-        for node1, info in graph.nodes.items():
-            if (node1 == point):
-                coordinates.append([info['x'], info['y']])
-    map = StaticMap(SIZE, SIZE)
-    line = Line(coordinates, 'red', 3)
-    map.add_line(line)
+    coordinates = path_coordinates(graph, path)
+    lines = [(coordinates, 'red', 3)]
 
     # plots source and target points
-    coordinates = [coordinates[0], coordinates[len(coordinates)-1]]
-    for coordinate in coordinates:
-        marker_outline = CircleMarker(coordinate, 'darkred', 8)
-        marker = CircleMarker(coordinate, 'red', 5)
-        map.add_marker(marker_outline)
-        map.add_marker(marker)
-
-    image = map.render()
-    image.save('shortestpath.png')
+    markers = []
+    for coordinate in [coordinates[0], coordinates[-1]]:
+        markers.append((coordinate, 'darkred', 8))
+        markers.append((coordinate, 'red', 5))
+
+    image = render_map(SIZE, lines, markers, basemap, tile_cache)
+    return encode_image(image, output, format, options)
+
+
+def plot_position(coordinate, SIZE, basemap=None, tile_cache=None,
+                  output=None, format='PNG', options=None):
+    """Plots a position in a map and returns the encoded image, unless it is
+    written in a given output.
+    ------------------------------------------------------------------------
+    Keyword arguments:
+    coordinate -- Longitude and latitude of the position.
+    SIZE -- Size of the map where we want to plot the position to.
+    basemap -- Basemap used as background instead of the map tiles.
+    tile_cache -- Tile cache where the map tiles are looked up.
+    output -- File, or buffer, where we want to write the image.
+    format -- Format of the image (PNG, JPEG or WEBP).
+    options -- Dictionary with the encoding options of the format.
+    """
+
+    markers = [(coordinate, 'blue', 10)]
+    image = render_map(SIZE, [], markers, basemap, tile_cache)
+    return encode_image(image, output, format, options)
 
 
 # 'if __name__ == "__function__"' allows us to run a function of the module
@@ -0,0 +1,302 @@
+# Authors: Sergio Cárdenas & Adrián Cerezuela
+
+import collections
+import contextlib
+import http.server
+import json
+import threading
+import time
+
+
+# upper bounds, in seconds, of the buckets of the timing histograms
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5,
+           10, 30)
+
+# timing histograms by stage (a count for every bucket, plus the sum and the
+# count of the timings), counters by (name, labels) and gauges computed when
+# the metrics are read. The events of the caches already counted are kept,
+# so only the new ones are added
+Registry = collections.namedtuple('Registry', ['histograms', 'counters',
+                                  'gauges', 'seen', 'lock'])
+
+
+def open_registry():
+    """Returns an empty registry of metrics.
+    """
+
+    return Registry({}, collections.Counter(), {}, {}, threading.Lock())
+
+
+# registry of the process, used when no other registry is given
+registry = open_registry()
+
+
+def observe(stage, seconds, registry=registry):
+    """Adds the duration of a stage to its timing histogram.
+    --------------------------------------------------------
+    Keyword arguments:
+    stage -- Name of the stage.
+    seconds -- Duration of the stage.
+    registry -- Registry of the metrics.
+    """
+
+    with registry.lock:
+        histogram = registry.histograms.get(stage)
+        if histogram is None:
+            histogram = registry.histograms[stage] = [0]*len(BUCKETS) + [0, 0]
+        for i, bound in enumerate(BUCKETS):
+            if (seconds <= bound):
+                histogram[i] += 1
+                break
+        histogram[-2] += seconds
+        histogram[-1] += 1
+
+
+def count(name, labels=(), value=1, registry=registry):
+    """Adds a value to a counter.
+    -----------------------------
+    Keyword arguments:
+    name -- Name of the counter.
+    labels -- Tuple of (label, value) pairs of the counter.
+    value -- Value we want to add.
+    registry -- Registry of the metrics.
+    """
+
+    with registry.lock:
+        registry.counters[(name, tuple(labels))] += value
+
+
+def gauge(name, function, registry=registry):
+    """Sets a gauge, whose value is computed by a function every time the
+    metrics are read.
+    ---------------------------------------------------------------------
+    Keyword arguments:
+    name -- Name of the gauge.
+    function -- Function without arguments that returns the value.
+    registry -- Registry of the metrics.
+    """
+
+    with registry.lock:
+        registry.gauges[name] = function
+
+
+@contextlib.contextmanager
+def timed(stage, registry=registry):
+    """Context manager that adds the duration of a stage to its histogram,
+    and counts an error of the stage if it raises an exception.
+    ----------------------------------------------------------------------
+    Keyword arguments:
+    stage -- Name of the stage.
+    registry -- Registry of the metrics.
+    """
+
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        count('errors', (('stage', stage),), registry=registry)
+        raise
+    finally:
+        observe(stage, time.perf_counter() - start, registry)
+
+
+def count_cache(cache, stats, registry=registry):
+    """Adds to the counters the events of a cache since the last time it was
+    counted.
+    ------------------------------------------------------------------------
+    Keyword arguments:
+    cache -- Name of the cache.
+    stats -- Counter with the events (hits, misses...) of the cache.
+    registry -- Registry of the metrics.
+    """
+
+    with registry.lock:
+        seen = registry.seen.setdefault(cache, collections.Counter())
+        for event, value in list(stats.items()):
+            if (value != seen[event]):
+                registry.counters[('cache_events', (('cache', cache),
+                                                    ('event', event)))] += \
+                    value - seen[event]
+                seen[event] = value
+
+
+def flush(registry=registry):
+    """Returns the histograms and counters of a registry, which is emptied,
+    so that they can be merged into the registry of another process.
+    -----------------------------------------------------------------------
+    Keyword arguments:
+    registry -- Registry of the metrics.
+    """
+
+    with registry.lock:
+        samples = (dict(registry.histograms), dict(registry.counters))
+        registry.histograms.clear()
+        registry.counters.clear()
+    return samples
+
+
+def merge(samples, registry=registry):
+    """Adds to a registry the histograms and counters flushed from another.
+    -----------------------------------------------------------------------
+    Keyword arguments:
+    samples -- Histograms and counters flushed from another registry.
+    registry -- Registry of the metrics.
+    """
+
+    histograms, counters = samples
+    with registry.lock:
+        for stage, other in histograms.items():
+            histogram = registry.histograms.setdefault(
+                stage, [0]*len(BUCKETS) + [0, 0])
+            for i, value in enumerate(other):
+                histogram[i] += value
+        registry.counters.update(counters)
+
+
+def hit_ratios(counters):
+    """Returns the hit ratio of every cache, from the counters of its events.
+    Every kind of hit (in memory or on disk) counts as a hit.
+    -------------------------------------------------------------------------
+    Keyword arguments:
+    counters -- Counters of a registry.
+    """
+
+    hits = collections.Counter()
+    lookups = collections.Counter()
+    for (name, labels), value in counters.items():
+        if (name != 'cache_events'):
+            continue
+        labels = dict(labels)
+        if labels['event'].endswith('hits'):
+            hits[labels['cache']] += value
+            lookups[labels['cache']] += value
+        elif (labels['event'] == 'misses'):
+            lookups[labels['cache']] += value
+    return {cache: hits[cache]/lookups[cache] for cache in lookups
+            if lookups[cache]}
+
+
+def format_labels(labels):
+    """Returns the labels of a metric in the Prometheus text format.
+    ----------------------------------------------------------------
+    Keyword arguments:
+    labels -- Tuple of (label, value) pairs.
+    """
+
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (label, value)
+                             for label, value in labels)
+
+
+def render(registry=registry):
+    """Returns the metrics of a registry in the Prometheus text format.
+    -------------------------------------------------------------------
+    Keyword arguments:
+    registry -- Registry of the metrics.
+    """
+
+    with registry.lock:
+        histograms = {stage: list(histogram)
+                      for stage, histogram in registry.histograms.items()}
+        counters = dict(registry.counters)
+        gauges = dict(registry.gauges)
+
+    lines = ['# TYPE igo_stage_seconds histogram']
+    for stage, histogram in sorted(histograms.items()):
+        cumulative = 0
+        for bound, value in zip(BUCKETS, histogram):
+            cumulative += value
+            lines.append('igo_stage_seconds_bucket%s %d' % (format_labels(
+                (('stage', stage), ('le', bound))), cumulative))
+        lines.append('igo_stage_seconds_bucket%s %d' % (format_labels(
+            (('stage', stage), ('le', '+Inf'))), histogram[-1]))
+        lines.append('igo_stage_seconds_sum%s %f'
+                     % (format_labels((('stage', stage),)), histogram[-2]))
+        lines.append('igo_stage_seconds_count%s %d'
+                     % (format_labels((('stage', stage),)), histogram[-1]))
+    names = sorted(set(name for name, labels in counters))
+    for name in names:
+        lines.append('# TYPE igo_%s_total counter' % name)
+        for (other, labels), value in sorted(counters.items()):
+            if (other == name):
+                lines.append('igo_%s_total%s %d'
+                             % (name, format_labels(labels), value))
+    lines.append('# TYPE igo_cache_hit_ratio gauge')
+    for cache, ratio in sorted(hit_ratios(counters).items()):
+        lines.append('igo_cache_hit_ratio%s %f'
+                     % (format_labels((('cache', cache),)), ratio))
+    for name, function in sorted(gauges.items()):
+        lines.append('# TYPE igo_%s gauge' % name)
+        lines.append('igo_%s %f' % (name, function()))
+    return '\n'.join(lines) + '\n'
+
+
+def summary(registry=registry):
+    """Returns a structured log line (JSON) with the count, mean and 95th
+    percentile (upper bound of its bucket, or None if it is over the last
+    one) of every stage, the errors, the hit ratio of every cache and the
+    gauges of a registry.
+    ---------------------------------------------------------------------
+    Keyword arguments:
+    registry -- Registry of the metrics.
+    """
+
+    with registry.lock:
+        histograms = {stage: list(histogram)
+                      for stage, histogram in registry.histograms.items()}
+        counters = dict(registry.counters)
+        gauges = dict(registry.gauges)
+
+    stages = {}
+    for stage, histogram in histograms.items():
+        total = histogram[-1]
+        cumulative = 0
+        p95 = None
+        for bound, value in zip(BUCKETS, histogram):
+            cumulative += value
+            if (cumulative >= 0.95*total):
+                p95 = bound
+                break
+        stages[stage] = {'count': total,
+                         'mean_ms': 1000*histogram[-2]/max(total, 1),
+                         'p95_ms': 1000*p95 if p95 is not None else None}
+    errors = {dict(labels)['stage']: value
+              for (name, labels), value in counters.items()
+              if (name == 'errors')}
+    line = {'time': time.time(), 'stages': stages, 'errors': errors,
+            'cache_hit_ratios': hit_ratios(counters)}
+    line.update({name: function() for name, function in gauges.items()})
+    return json.dumps(line, sort_keys=True)
+
+
+def serve(port, registry=registry, host='127.0.0.1'):
+    """Serves the metrics of a registry in the Prometheus text format, from a
+    thread, at http://host:port/metrics, and returns the server.
+    -------------------------------------------------------------------------
+    Keyword arguments:
+    port -- Port of the server.
+    registry -- Registry of the metrics.
+    host -- Address of the server, which is only local by default.
+    """
+
+    class MetricsHandler(http.server.BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            if (self.path != '/metrics'):
+                self.send_error(404)
+                return
+            body = render(registry).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass  # the scrapes are not logged
+
+    server = http.server.ThreadingHTTPServer((host, port), MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
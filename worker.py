@@ -0,0 +1,180 @@
+# Authors: Sergio Cárdenas & Adrián Cerezuela
+
+import igo
+import metrics
+
+
+# every worker process loads its own state once, when it is started. The
+# routing data is memory-mapped read-only, so all the workers share the same
+# pages of memory and only the weights are published again on every update
+routing_data = None
+spatial_index = None
+geocode_cache = None
+tile_cache = None
+basemap = None
+options = None
+route_cache = None
+landmarks = None
+weights = None, None, None, None, None
+# metrics of the worker, which are sent to the bot with every result
+registry = metrics.open_registry()
+
+
+def init(ROUTING_DIRECTORY, SPATIAL_INDEX_FILENAME, GEOCODE_FILENAME,
+         TILES_DIRECTORY, map_basemap, map_options, ROUTE_CACHE_SIZE=1024,
+         tile_downloads=4):
+    """Loads the state of a worker. It is the initializer of the process pool
+    of the bot, but it can also be called in the bot process itself.
+    -------------------------------------------------------------------------
+    Keyword arguments:
+    ROUTING_DIRECTORY -- Name of the directory of the routing data.
+    SPATIAL_INDEX_FILENAME -- Name of the file of the spatial index.
+    GEOCODE_FILENAME -- Name of the database of the geocoded locations.
+    TILES_DIRECTORY -- Name of the directory of the map tiles.
+    map_basemap -- Basemap of the maps, or None.
+    map_options -- Dictionary with the SIZE, format and options of the maps,
+                   and if the images are kept in the route cache ('images').
+    ROUTE_CACHE_SIZE -- Maximum number of routes kept in the route cache.
+    tile_downloads -- Maximum number of map tiles downloaded at the same time
+                      by the worker, or a semaphore shared by all of them.
+    """
+
+    global routing_data, spatial_index, geocode_cache, tile_cache, basemap
+    global options, route_cache, landmarks
+    routing_data = igo.load_routing_data(ROUTING_DIRECTORY)
+    # the distances of the landmarks are read node by node by the searches
+    landmarks = igo.landmark_lists(routing_data.landmarks)
+    spatial_index = igo.load_spatial_index(SPATIAL_INDEX_FILENAME,
+                                           routing_data)
+    geocode_cache = igo.open_geocode_cache(GEOCODE_FILENAME)
+    tile_cache = igo.open_tile_cache(TILES_DIRECTORY,
+                                     downloads=tile_downloads)
+    basemap = map_basemap
+    options = map_options
+    route_cache = igo.open_route_cache(ROUTE_CACHE_SIZE)
+
+
+def get_weights(WEIGHTS_FILENAME, PLANNED_FILENAME=None):
+    """Returns the compressed layout of the graph with the given version of
+    the weights, the planned itimes and the lists of both used by the
+    searches, which are memory-mapped and built the first time they are
+    asked for.
+    -----------------------------------------------------------------------
+    Keyword arguments:
+    WEIGHTS_FILENAME -- Name of the file of the weights.
+    PLANNED_FILENAME -- Name of the file of the planned itimes, or None.
+    """
+
+    global weights
+    # the names and the arrays are swapped together, so the threads of the
+    # bot process can share a worker state too
+    filename, planned_filename, csr, planned, lists = weights
+    if (WEIGHTS_FILENAME != filename or PLANNED_FILENAME != planned_filename):
+        old_csr, old_planned = csr, planned
+        csr = routing_data.csr._replace(
+            weights=igo.load_weights(WEIGHTS_FILENAME))
+        planned = None
+        if PLANNED_FILENAME is not None:
+            planned = igo.load_weights(PLANNED_FILENAME)
+        lists = igo.csr_lists(csr, planned, lists)
+        weights = WEIGHTS_FILENAME, PLANNED_FILENAME, csr, planned, lists
+        # the cached routes that are still the shortest ones move to the new
+        # version of the weights
+        if old_csr is not None:
+            igo.invalidate_routes(route_cache, (filename, planned_filename),
+                                  (WEIGHTS_FILENAME, PLANNED_FILENAME),
+                                  [old_csr.weights, old_planned],
+                                  [csr.weights, planned])
+    return csr, planned, lists
+
+
+def go(source, target, WEIGHTS_FILENAME, PLANNED_FILENAME=None):
+    """Finds the shortest path between two locations with the given version
+    of the weights and returns the encoded map of the path, and the metrics
+    of the worker.
+    -----------------------------------------------------------------------
+    Keyword arguments:
+    source -- Source location.
+    target -- Target location.
+    WEIGHTS_FILENAME -- Name of the file of the weights.
+    PLANNED_FILENAME -- Name of the file of the planned itimes. If it is
+                        given, the edges reached after the first minutes of
+                        the trip have the planned itime.
+    """
+
+    csr, planned, lists = get_weights(WEIGHTS_FILENAME, PLANNED_FILENAME)
+    version = (WEIGHTS_FILENAME, PLANNED_FILENAME)
+    source_node = find_node(source)
+    target_node = find_node(target)
+    # the popular routes are only found once for every version of the weights
+    route = igo.get_route(route_cache, version, source_node, target_node)
+    if route is None:
+        with metrics.timed('route', registry):
+            ipath = igo.get_shortest_path_with_ispeeds(
+                routing_data, source_node, target_node, csr,
+                landmarks, planned=planned, lists=lists)
+            route = igo.build_route(csr, ipath, planned)
+        igo.cache_route(route_cache, version, source_node, target_node, route)
+    if route.image is not None:
+        return route.image, collect()
+    with metrics.timed('render', registry):
+        image = igo.plot_path(routing_data, route.path, options['SIZE'],
+                              basemap, tile_cache, format=options['format'],
+                              options=options['options'])
+    if options.get('images'):
+        igo.cache_route(route_cache, version, source_node, target_node,
+                        route._replace(image=image))
+    return image, collect()
+
+
+def find_node(location):
+    """Returns the nearest node of a location, timing its geocoding and the
+    search of the node.
+    -----------------------------------------------------------------------
+    Keyword arguments:
+    location -- Name of the location, its latitude and longitude, or the
+                node itself.
+    """
+
+    if isinstance(location, (int, igo.np.integer)):
+        return location
+    with metrics.timed('geocode', registry):
+        latitude, longitude = igo.geocode(location, geocode_cache)
+    with metrics.timed('nearest_node', registry):
+        return igo.nearest_nodes(spatial_index, longitude, latitude)
+
+
+def collect():
+    """Returns the metrics of the worker since the last time they were
+    collected, with the events of its caches.
+    ------------------------------------------------------------------
+    """
+
+    metrics.count_cache('geocode', geocode_cache.stats, registry)
+    metrics.count_cache('tiles', tile_cache.stats, registry)
+    metrics.count_cache('routes', route_cache.stats, registry)
+    return metrics.flush(registry)
+
+
+def locate(location):
+    """Returns the nearest node of a location, and the metrics of the worker.
+    -------------------------------------------------------------------------
+    Keyword arguments:
+    location -- Name of the location, or its latitude and longitude.
+    """
+
+    return find_node(location), collect()
+
+
+def where(coordinate):
+    """Returns the encoded map of a position, and the metrics of the worker.
+    ------------------------------------------------------------------------
+    Keyword arguments:
+    coordinate -- Coordinate (longitude, latitude) of the position.
+    """
+
+    with metrics.timed('render', registry):
+        image = igo.plot_position(coordinate, options['SIZE'], basemap,
+                                  tile_cache, format=options['format'],
+                                  options=options['options'])
+    return image, collect()